@@ -6,20 +6,24 @@ import json
 import random
 import logging
 import datetime
-import requests
-import magic
 
-from flask import Flask, request, send_file, render_template, make_response, \
-                send_from_directory, current_app, session, url_for
+from flask import Flask, request, render_template, make_response, \
+                current_app, g, abort
 
-from htmlmin.main import minify
 from html.parser import HTMLParser
 from io import StringIO
 
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-from .extensions import cors, cache, mail
+from .extensions import cors, cache, mail, mail_queue, recaptcha, route_index, mime_detector, \
+                template_analyzer, page_cache, minify_cache, compressor, site_build, \
+                conditional_pages, metrics, template_warmup, streaming_pages, static_files, \
+                fragment_cache, assets, image_derivatives, preload_hints
 from .config import config as env_config
+from .routing import TEMPLATE
+from .template_minify import MinifyExtension
+from .fragment_cache import FragmentCacheExtension
+from .template_context import static_context, request_context, ip_check_digits
 
 from flask_mail import Message
 
@@ -95,6 +99,7 @@ def configure_app(app, config=None, blueprints=None):
     configure_logging(app)
     configure_template_filters(app)
     configure_error_handlers(app)
+    configure_warmup(app)
 
     return app
 
@@ -110,17 +115,64 @@ def configure_app_config(app, forced_config=None):
 def configure_hook(app):
     @app.before_request
     def before_request():
-        pass
+        metrics.start()
     
+    @app.teardown_request
+    def teardown_page_cache(exception):
+        # wake the requests waiting for the page this one rendered, stored or not
+        page_cache.release()
+
+    # after_request hooks run in reverse order of registration
+
+    @app.after_request
+    def response_metrics(response):
+        """
+        record the request timings, once every other hook is done
+        """
+        return metrics.finish(response)
+
+    @app.after_request
+    def response_preload(response):
+        """
+        Link: rel=preload for the subresources of the rendered template
+        """
+        return preload_hints.finalize(response)
+
+    @app.after_request
+    def response_compress(response):
+        """
+        gzip/brotli compress the final body when the client accepts it
+        """
+        with metrics.stage('compress'):
+            return compressor.compress_response(response)
+
+    @app.after_request
+    def response_conditional(response):
+        """
+        ETag, Last-Modified and Cache-Control for rendered templates
+        """
+        return conditional_pages.finalize(response)
+
+    @app.after_request
+    def response_page_cache(response):
+        """
+        store the final (minified) body of pages marked by page_cache.get
+        """
+        return page_cache.store(response)
+
     @app.after_request
     def response_minify(response):
         """
         minify html response to decrease site traffic
         """
-        if response.content_type == u'text/html; charset=utf-8' and env_config.APPLICATION_ENV == 'production':
-            response.set_data(
-                minify(response.get_data(as_text=True))
-            )
+        if g.get('page_cache_hit') or response.direct_passthrough or response.is_streamed:
+            return response
+
+        if response.mimetype == u'text/html' and env_config.MINIFY_MODE == 'response':
+            with metrics.stage('minify'):
+                response.set_data(
+                    minify_cache.minify(response.get_data(as_text=True))
+                )
 
             return response
         return response
@@ -134,12 +186,60 @@ def configure_extensions(app):
     cors.init_app(app, supports_credentials=True)
     # cors.init_app(app, supports_credentials=True, resources={r"/*": {"origins": "*"}})
 
+    # Request and stage timings, /metrics when enabled
+    metrics.init_app(app)
+
     # Initialize Flask-Mail
     mail.init_app(app)
+    mail_queue.init_app(app)
+
+    # Pooled, time bounded reCAPTCHA siteverify client
+    recaptcha.init_app(app)
 
     # Initialize Flask-Cache
     cache.init_app(app)
 
+    # Index the template trees once, lookups are plain dict accesses
+    route_index.init_app(app)
+
+    # One libmagic handle per process, with an extension fast path
+    mime_detector.init_app(app)
+
+    # Opt-in cache of rendered pages, keyed on what each template reads
+    template_analyzer.init_app(app)
+    page_cache.init_app(app)
+    fragment_cache.init_app(app)
+
+    # Identical bodies are minified once
+    minify_cache.init_app(app)
+
+    # Small static files served from memory, the others with sendfile and Range support
+    static_files.init_app(app)
+
+    # Compressed responses and precompressed static files
+    compressor.init_app(app)
+
+    # Content hashed, immutable URLs for the files under STATIC_PATH
+    assets.init_app(app)
+
+    # Resized WebP/AVIF copies of the images under STATIC_IMAGES_PATH, made in a process pool
+    image_derivatives.init_app(app)
+
+    # Link: rel=preload and 103 Early Hints for the subresources of each template
+    preload_hints.init_app(app)
+
+    # Pre-rendered pages and the build-site command
+    site_build.init_app(app)
+
+    # Validators and 304s for rendered templates
+    conditional_pages.init_app(app)
+
+    # Bytecode cache shared by the workers, readiness endpoint
+    template_warmup.init_app(app)
+
+    # Large pages are sent while they render
+    streaming_pages.init_app(app)
+
 
 def configure_logging(app):
     # Configure logging
@@ -159,6 +259,15 @@ def configure_template_filters(app):  # sourcery skip: none-compare
     
     app.jinja_env.add_extension('jinja2.ext.do')
 
+    # {% cache key, timeout %}...{% endcache %}
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.fragment_cache = fragment_cache
+
+    if env_config.MINIFY_MODE == 'compile':
+        app.jinja_env.add_extension(MinifyExtension)
+        app.jinja_env.minify_remove_comments = env_config.MINIFY_REMOVE_COMMENTS
+        app.jinja_env.minify_exclude = env_config.MINIFY_EXCLUDE
+
     @app.template_filter()
     def readable_size(value, suffix="b"):
         for unit in ["", "K", "M", "G", "T", "P", "E", "Z"]:
@@ -367,45 +476,58 @@ def configure_template_filters(app):  # sourcery skip: none-compare
 
     app.jinja_env.globals.update(dirname=dirname)
 
-    @app.context_processor
-    def inject():
-        global_dict = {
-            'now': datetime.datetime.now(datetime.timezone.utc),
-            'current_url': request.url_rule.endpoint if request.url_rule else '',
-            'current_date': datetime.datetime.now(),
-            'config': env_config,
-            'application_env': env_config.APPLICATION_ENV,
-            'session': session,
-            'request': request,
-            'get_url': url_for,
-            'check_ip_string': [str(octet[0]) for octet in request.remote_addr.split('.')],
-            'ADMIN_URL_PREFIX': env_config.ADMIN_URL_PREFIX,
-            'BASE_URL': env_config.BASE_URL,
-            'STATIC_URL': env_config.STATIC_URL,
-            'URLS': env_config.URLS,
-            'TIMEZONE': env_config.TIMEZONE,
-            'DATE_TIME_FORMAT': env_config.DATE_TIME_FORMAT,
-            'DATE_FORMAT': env_config.DATE_FORMAT,
-            'APPLICATION_PATH': env_config.APPLICATION_PATH,
-            'INSTANCE_FOLDER_PATH': env_config.INSTANCE_FOLDER_PATH,
-            'BASE_PATH': env_config.BASE_PATH,
-            'STATIC_PATH': env_config.STATIC_PATH,
-            'STATIC_IMAGES_PATH': env_config.STATIC_IMAGES_PATH,
-            'PATHS': env_config.PATHS,
-        }
-
-        return global_dict
-    
+    # Constants once per app, the request dependent values on first use
+    app.jinja_env.globals.update(static_context(env_config))
+    app.jinja_env.globals.update(asset_url=assets.asset_url)
+    app.jinja_env.globals.update(image_srcset=image_derivatives.srcset,
+                                 responsive_image=image_derivatives.responsive_image)
+    app.jinja_env.globals.update(request_context())
+
+
+def configure_warmup(app):
+    # Last, the template environment is complete by now
+    template_warmup.warmup()
+    if template_warmup.enabled:
+        preload_hints.warmup(sorted({route.name for route in route_index.routes.values()
+                                     if route.kind == TEMPLATE}))
 
 
 def configure_error_handlers(app):
+    # Status pages rendered once at startup and again only when their template changes,
+    # a scan answered with thousands of 404s must not render thousands of pages
+    status_pages = {}
+    # codes whose page could not be rendered outside a request
+    per_request = set()
+
+    def render_status_page(code):
+        name = f'http_statuses/{code}.html'
+        info = template_analyzer.analyse(name)
+        if code in per_request or not template_analyzer.is_request_independent(info):
+            return render_template(name)
+        signature = template_analyzer.signature(info)
+        if 'asset_url' in info.context_names:
+            signature += (assets.version,)
+        cached = status_pages.get(code)
+        if cached is None or cached[0] != signature:
+            cached = status_pages[code] = (signature, render_template(name))
+        return cached[1]
+
+    with app.app_context():
+        for code in (403, 404, 500):
+            try:
+                render_status_page(code)
+            except Exception:
+                # a value the analysis missed, eg. read through a macro; render it
+                # the way it always was rather than refuse to start
+                app.logger.warning('Rendering http_statuses/%s.html per request', code, exc_info=True)
+                per_request.add(code)
 
     @app.errorhandler(403)
     def forbidden_page(error):
         return (
             ("Oops! You don't have permission to access this page.", 403)
             if request.is_json
-            else (render_template('http_statuses/403.html'), 403)
+            else (render_status_page(403), 403)
         )
 
     @app.errorhandler(404)
@@ -413,7 +535,7 @@ def configure_error_handlers(app):
         return (
             ("Ooops! Page not found.", 404)
             if request.is_json
-            else (render_template('http_statuses/404.html'), 404)
+            else (render_status_page(404), 404)
         )
 
     @app.errorhandler(500)
@@ -421,7 +543,7 @@ def configure_error_handlers(app):
         return (
             ("Oops! Internal server error. Please try after sometime.", 500)
             if request.is_json
-            else (render_template('http_statuses/500.html'), 500)
+            else (render_status_page(500), 500)
         )
 
 """
@@ -432,36 +554,31 @@ def configure_error_handlers(app):
 
 @app.route("/favicon.ico")
 def favicon():
-    return send_from_directory(os.path.join(env_config.BASE_PATH, 'images'),
+    return compressor.send_from_directory(os.path.join(env_config.BASE_PATH, 'images'),
                 'favicon.ico',mimetype='image/vnd.microsoft.icon')
 
 @app.route("/", methods=["GET", "POST"], defaults={'path': "index.html"})
 @app.route("/<path:path>", methods=["GET", "POST"])
 def template_render_path(path):
+    with metrics.stage('route'):
+        route = route_index.lookup(path)
+    metrics.set_path(route.name if route else 'not_found')
+
+    if not route:
+        # before touching the form, most misses are scanners probing for well known paths
+        abort(404)
+
     error_code = 0
     error_msg = ""
-    if request.method == "POST" and request.form['form-name'] == 'mail-contact-form':
+    if request.method == "POST" and request.form.get('form-name') == 'mail-contact-form':
         def is_valid():
             try:
-                if env_config.EMAIL_SEND and env_config.APPLICATION_ENV == 'production':
-                    url = 'https://www.google.com/recaptcha/api/siteverify'
-                    data = {
-                        'secret': env_config.RECAPTCHA_V3_SECRET_KEY,
-                        'response': request.form['g-recaptcha-response'],
-                        'remoteip': request.remote_addr
-                    }
-                    headers = {
-                        'Content-Type': 'application/x-www-form-urlencoded'
-                    }
-                    response = requests.post(url, data=data, headers=headers)
-                    result = response.json()
-                return ( env_config.EMAIL_SEND and env_config.APPLICATION_ENV == 'production' and result['success'] and sum(
-                    int(octet[0])
-                    for octet in request.remote_addr.split('.')
-                ) == int(request.form['check']) ) or ( sum(
-                    int(octet[0])
-                    for octet in request.remote_addr.split('.')
-                ) == int(request.form['check']) )
+                digits = ip_check_digits(request.remote_addr)
+                check = bool(digits) and sum(digits) == int(request.form['check'])
+                if check and env_config.EMAIL_SEND and env_config.APPLICATION_ENV == 'production':
+                    with metrics.stage('recaptcha'):
+                        return recaptcha.verify(request.form.get('g-recaptcha-response'), request.remote_addr)
+                return check
             except Exception:
                 return False
 
@@ -474,7 +591,8 @@ def template_render_path(path):
                         recipients=[(env_config.EMAIL_DEST, env_config.EMAIL_DEST_NAME)]
                     )
                     msg.body = f'IP:{request.remote_addr}' + '\n\n' + request.form['message']
-                    mail.send(msg)
+                    with metrics.stage('mail'):
+                        mail_queue.send(msg)
             except Exception as e:
                 error_code = 1
                 error_msg = str(e)
@@ -482,28 +600,41 @@ def template_render_path(path):
             error_code = 2
             error_msg = "Robot check validation failed."
 
-    paths = [
-        f'{env_config.TEMPLATES_PATH}{os.sep}{path}',
-        f'{env_config.TEMPLATES_PATH}{os.sep}{path}.htm',
-        f'{env_config.TEMPLATES_PATH}{os.sep}{path}.html',
-        f'{env_config.STATIC_TEMPLATES_PATH}{os.sep}{path}',
-        f'{env_config.STATIC_TEMPLATES_PATH}{os.sep}{path}.htm',
-        f'{env_config.STATIC_TEMPLATES_PATH}{os.sep}{path}.html',
-    ]
-
-    for path in paths:
-        if os.path.exists(path):
-            mime = magic.Magic(mime=True)
-            mime_type = mime.from_file(path)
-
-            if mime_type:
-                if path.startswith(env_config.TEMPLATES_PATH):
-                    response = make_response(render_template(path[len(env_config.TEMPLATES_PATH)+1:], error_code=error_code, error_msg=error_msg))
-                    response.headers['Content-Type'] = mime_type
-                    return response
-                else:
-                    return send_file(path, mimetype=mime_type)
-            else:
-                return "MIME type not supported for this file."
-
-    return "Not found"
+    with metrics.stage('mime'):
+        mime_type = mime_detector.from_file(route.path)
+
+    if mime_type:
+        if route.kind == TEMPLATE:
+            # the browser fetches the stylesheets and scripts while the page is produced
+            preload_hints.announce(route.name)
+
+            built = site_build.get(route.name)
+            if built is not None:
+                response = compressor.send_file(built, mimetype=mime_type)
+                return conditional_pages.set_cache_control(response, route.name)
+
+            response = conditional_pages.precondition(route.name)
+            if response is not None:
+                return response
+
+            with metrics.stage('cache'):
+                response = page_cache.get(route.name)
+            if response is not None:
+                return response
+
+            # a page the cache stores is rendered whole, the requests waiting for it get a hit
+            if streaming_pages.should_stream(route.name) and g.get('page_cache_key') is None:
+                response = streaming_pages.stream(route.name, mime_type, error_code=error_code, error_msg=error_msg)
+                response.headers['Content-Type'] = mime_type
+                return response
+
+            with metrics.stage('render'):
+                html = render_template(route.name, error_code=error_code, error_msg=error_msg)
+            streaming_pages.record(route.name, len(html))
+            response = make_response(html)
+            response.headers['Content-Type'] = mime_type
+            return response
+        else:
+            return compressor.send_file(route.path, mimetype=mime_type)
+    else:
+        return "MIME type not supported for this file."
\ No newline at end of file
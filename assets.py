@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import posixpath
+
+import click
+
+from flask import url_for, current_app
+from flask.cli import with_appcontext
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+from .compression import SUFFIXES
+
+
+# Hex digits of the content hash put in the asset file names
+HASH_LENGTH = 12
+
+
+def fingerprint(name, digest):
+    # css/site.css -> css/site.<digest>.css
+    root, ext = posixpath.splitext(name)
+    return f'{root}.{digest}{ext}'
+
+
+def unfingerprint(name):
+    # css/site.<digest>.css -> css/site.css, None without a digest
+    root, ext = posixpath.splitext(name)
+    stem, _, digest = root.rpartition('.')
+    if not stem or len(digest) != HASH_LENGTH or digest.strip('0123456789abcdef'):
+        return None
+    return stem + ext
+
+
+class Assets(object):
+    """
+    manifest of the files under STATIC_PATH with a content hash in their
+    name, served as immutable from ASSETS_URL
+    """
+
+    def __init__(self, compressor=None, app=None):
+        self.compressor = compressor
+        self.root = None
+        self.manifest_path = None
+        self.url = None
+        self.max_age = None
+        self.auto_refresh = False
+        # static name -> {'hash', 'mtime', 'size'}
+        self.manifest = {}
+        # fingerprinted name -> static name
+        self.names = {}
+        # digest of every hash in the manifest and the newest mtime in it, for the
+        # caches of the pages linking the assets
+        self.version = None
+        self.modified = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.root = app.config.get('STATIC_PATH')
+        self.manifest_path = app.config.get('ASSETS_MANIFEST_PATH')
+        self.url = app.config.get('ASSETS_URL')
+        self.max_age = app.config.get('ASSETS_MAX_AGE')
+        self.auto_refresh = app.config.get('ASSETS_AUTO_REFRESH', False)
+
+        self.load()
+        if app.config.get('ASSETS_BUILD_ON_STARTUP', False):
+            self.build()
+
+        app.add_url_rule(f'{self.url}/<path:filename>', 'assets', self.view)
+        app.cli.add_command(build_assets_command)
+        app.extensions['assets'] = self
+
+    def load(self):
+        try:
+            with open(self.manifest_path) as file:
+                self.manifest = json.load(file).get('assets', {})
+        except (OSError, ValueError):
+            self.manifest = {}
+        self._index()
+
+    def build(self, force=False):
+        """
+        hash the files added or changed since the last manifest, return the
+        names hashed
+        """
+        manifest = {}
+        hashed = []
+        for directory, _, files in os.walk(self.root):
+            for filename in files:
+                # precompressed siblings go out with their source file
+                if filename.endswith(tuple(SUFFIXES.values())):
+                    continue
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, self.root).replace(os.sep, '/')
+                entry = self._entry(name, path, None if force else self.manifest.get(name))
+                if entry is None:
+                    continue
+                if entry is not self.manifest.get(name):
+                    hashed.append(name)
+                manifest[name] = entry
+
+        if hashed or manifest.keys() != self.manifest.keys():
+            self.manifest = manifest
+            self._index()
+            self._save()
+        return hashed
+
+    def _entry(self, name, path, previous):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if previous and previous['mtime'] == stat.st_mtime_ns and previous['size'] == stat.st_size:
+            return previous
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(block)
+        return {'hash': digest.hexdigest()[:HASH_LENGTH], 'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+
+    def _index(self):
+        self.names = {fingerprint(name, entry['hash']): name for name, entry in self.manifest.items()}
+        hashes = repr(sorted((name, entry['hash']) for name, entry in self.manifest.items()))
+        self.version = hashlib.blake2b(hashes.encode('utf-8'), digest_size=8).hexdigest()
+        self.modified = max((entry['mtime'] for entry in self.manifest.values()), default=None)
+
+    def _save(self):
+        if not self.manifest_path:
+            return
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        # write then rename, the other workers may be reading it
+        tmp = f'{self.manifest_path}.tmp{os.getpid()}'
+        with open(tmp, 'w') as file:
+            json.dump({'assets': self.manifest}, file, indent=2, sort_keys=True)
+        os.replace(tmp, self.manifest_path)
+
+    def refresh(self, name):
+        # development edits show up without a restart
+        path = safe_join(self.root, name)
+        if path is None:
+            return
+        entry = self._entry(name, path, self.manifest.get(name))
+        if entry is None:
+            self.manifest.pop(name, None)
+        elif entry is not self.manifest.get(name):
+            self.manifest[name] = entry
+        else:
+            return
+        self._index()
+
+    def asset_url(self, filename):
+        """
+        fingerprinted URL of `filename` under STATIC_PATH, the plain static
+        URL for files not in the manifest
+        """
+        if self.auto_refresh:
+            self.refresh(filename)
+        entry = self.manifest.get(filename)
+        if entry is None:
+            return url_for('static', filename=filename)
+        return f"{self.url}/{fingerprint(filename, entry['hash'])}"
+
+    def is_current(self, name):
+        # the file on disk is still the one hashed in the manifest
+        entry = self.manifest.get(name)
+        try:
+            stat = os.stat(os.path.join(self.root, name))
+        except OSError:
+            return False
+        return entry is not None and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size
+
+    def view(self, filename):
+        name = self.names.get(filename)
+        if name is not None and not self.is_current(name):
+            # changed since the manifest was written, eg. in production or in a
+            # worker forked before the edit; hash it again for the next pages
+            self.refresh(name)
+            name = None
+        if name is None:
+            # linked by a page rendered before the file changed, send what
+            # there is now without promising it never changes
+            name = unfingerprint(filename)
+            if name is None or name not in self.manifest or not os.path.isfile(os.path.join(self.root, name)):
+                raise NotFound()
+            return self.compressor.send_file(os.path.join(self.root, name))
+
+        response = self.compressor.send_file(os.path.join(self.root, name), max_age=self.max_age)
+        # the content of a fingerprinted URL never changes
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+
+@click.command('build-assets')
+@click.option('--force', is_flag=True, help='Hash every file, not only the changed ones.')
+@with_appcontext
+def build_assets_command(force):
+    """Fingerprint the files under STATIC_PATH for asset_url."""
+    assets = current_app.extensions['assets']
+    hashed = assets.build(force=force)
+    for name in hashed:
+        click.echo(f'hashed {name}')
+    click.echo(f'{len(hashed)} hashed, {len(assets.manifest) - len(hashed)} up to date in {assets.manifest_path}')
@@ -0,0 +1,635 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks and load tests for the request pipeline.
+
+Run from the package directory with its parent on the path, eg:
+
+    PYTHONPATH=.. python -m <package>.benchmarks mime
+    PYTHONPATH=.. python -m <package>.benchmarks --output after.json --baseline before.json
+
+Latencies are in microseconds (`*_us`, lower is better), throughputs in
+`*_per_s` (higher is better). With --baseline any of them worse than the
+saved run by more than --threshold is reported and the exit status is 1.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import datetime
+import threading
+import tracemalloc
+import subprocess
+import http.client
+
+import magic
+
+from flask import render_template, render_template_string, stream_template_string, template_rendered
+from flask_mail import Message
+from htmlmin.main import minify
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from . import init_app
+from .config import config as env_config
+from .extensions import mime_detector, route_index, mail, mail_queue, minify_cache, page_cache, cache
+from .template_minify import HTMLMinifyState, minify_chunks
+from .template_context import static_context, REQUEST_CONTEXT
+from .tests.smtp import SMTPSink
+
+
+def measure(func, repeat=2000):
+    # Returns the mean latency of func in microseconds
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def summarize(latencies, elapsed):
+    # Latencies in seconds to the p50/p95/p99 and throughput of a load run
+    return {
+        'p50_us': percentile(latencies, 50) * 1e6,
+        'p95_us': percentile(latencies, 95) * 1e6,
+        'p99_us': percentile(latencies, 99) * 1e6,
+        'requests_per_s': len(latencies) / elapsed,
+    }
+
+
+def request_context(app, path='/'):
+    return app.test_request_context(path, environ_base={'REMOTE_ADDR': '127.0.0.1'})
+
+
+def bench_routing(app, repeat):
+    return {
+        'lookup': {
+            'template_us': measure(lambda: route_index.lookup('index.html'), repeat),
+            'suffixless_us': measure(lambda: route_index.lookup('dynamic/index'), repeat),
+            'miss_us': measure(lambda: route_index.lookup('missing/page'), repeat),
+        },
+    }
+
+
+def bench_mime(app, repeat):
+    route = route_index.lookup('index.html')
+    paths = {
+        'template': route.path,
+        'favicon': os.path.join(app.config['BASE_PATH'], 'images', 'favicon.ico'),
+    }
+
+    results = {}
+    for label, path in paths.items():
+        results[label] = {
+            'magic_per_request_us': measure(lambda: magic.Magic(mime=True).from_file(path), repeat),
+            'shared_magic_us': measure(lambda: mime_detector.sniff(path), repeat),
+            'detector_us': measure(lambda: mime_detector.from_file(path), repeat),
+        }
+    return results
+
+
+def bench_render(app, repeat):
+    results = {}
+    with request_context(app):
+        def eager():
+            # what the inject context processor rebuilt for every render
+            context = static_context(env_config)
+            context.update((name, func()) for name, func in REQUEST_CONTEXT.items())
+            app.update_template_context(context)
+
+        results['context'] = {
+            'eager_us': measure(eager, repeat),
+            'lazy_us': measure(lambda: app.update_template_context({}), repeat),
+        }
+        results['template'] = {
+            name.replace('/', '_').replace('.html', '') + '_us':
+                measure(lambda: render_template(name, error_code=0, error_msg=''), repeat)
+            for name in ('index.html', 'dynamic/index.html', 'http_statuses/404.html')
+        }
+    return results
+
+
+def bench_minify(app, repeat):
+    with request_context(app):
+        html = render_template('index.html', error_code=0, error_msg='')
+
+    def compile_time():
+        state = HTMLMinifyState()
+        state.feed(html)
+
+    return {
+        'index': {
+            'htmlmin_us': measure(lambda: minify(html, remove_comments=True), repeat),
+            'minify_cache_us': measure(lambda: minify_cache.minify(html), repeat),
+            'compile_state_us': measure(compile_time, repeat),
+            'bytes': len(html),
+        },
+    }
+
+
+LARGE_PAGE = '''<table>
+{% for i in range(rows) %}
+  <tr>
+    <td> item {{ i }} </td>   <td> <!-- square --> {{ i * i }} </td>
+  </tr>
+{% endfor %}
+</table>'''
+
+
+def bench_streaming(app, repeat):
+    rows = max(500, repeat)
+
+    def buffered():
+        html = render_template_string(LARGE_PAGE, rows=rows)
+        minified = minify(html, remove_comments=True)
+        return minified.encode('utf-8')
+
+    def streamed():
+        chunks = minify_chunks(stream_template_string(LARGE_PAGE, rows=rows))
+        first = next(chunks).encode('utf-8')
+        yield first
+        for chunk in chunks:
+            yield chunk.encode('utf-8')
+
+    results = {}
+    with request_context(app):
+        for label, render in (('buffered', lambda: iter([buffered()])), ('streamed', streamed)):
+            start = time.perf_counter()
+            chunks = render()
+            next(chunks)
+            first = time.perf_counter() - start
+            for _ in chunks:
+                pass
+            total = time.perf_counter() - start
+
+            # a second run for the memory, tracing slows it down
+            tracemalloc.start()
+            for _ in render():
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            results[label] = {
+                'first_byte_us': first * 1e6,
+                'total_us': total * 1e6,
+                'peak_kib': peak / 1024,
+            }
+    return results
+
+
+def bench_filters(app, repeat):
+    filters = app.jinja_env.filters
+    html = '<p>Hello <b>world</b>, <a href="#">link</a></p>' * 10
+    date = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=3, hours=2)
+    return {
+        'filters': {
+            'strip_html_us': measure(lambda: filters['strip_html'](html), repeat),
+            'pretty_date_us': measure(lambda: filters['_pretty_date'](date), repeat),
+            'summarize_us': measure(lambda: filters['summarize'](html), repeat),
+            'var_name_to_string_us': measure(lambda: filters['var_name_to_string']('someVariable_name-here'), repeat),
+        },
+    }
+
+
+def bench_mail(app, repeat):
+    sink = SMTPSink(latency=0.02).start()
+    app.config.update(
+        MAIL_SERVER='127.0.0.1',
+        MAIL_PORT=sink.server_address[1],
+        MAIL_USE_SSL=False,
+        MAIL_USE_TLS=False,
+        MAIL_USERNAME=None,
+        MAIL_PASSWORD=None,
+        MAIL_SUPPRESS_SEND=False,
+        MAIL_DEBUG=False,
+    )
+    mail.init_app(app)
+    count = max(1, repeat // 20)
+
+    def message():
+        return Message('benchmark', sender='bench@localhost', recipients=['sink@localhost'], body='x' * 512)
+
+    with app.app_context():
+        start = time.perf_counter()
+        for _ in range(count):
+            mail.send(message())
+        inline = time.perf_counter() - start
+
+        mail_queue.enabled = True
+        start = time.perf_counter()
+        for _ in range(count):
+            mail_queue.send(message())
+        enqueued = time.perf_counter() - start
+        while sink.received < 2 * count:
+            time.sleep(0.001)
+        drained = time.perf_counter() - start
+
+    sink.shutdown()
+    return {
+        'inline': {
+            'request_us': inline / count * 1e6,
+            'messages_per_s': count / inline,
+        },
+        'queued': {
+            'request_us': enqueued / count * 1e6,
+            'messages_per_s': count / drained,
+            'smtp_connections': sink.connections - count,
+        },
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_listening(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Server on port {port} did not start')
+
+
+def serve(workers, reuse_port=False, sendfile=True):
+    # wsgi.py in a child process, returns it with the port it listens on
+    port = free_port()
+    command = [sys.executable, '-m', f'{__package__}.wsgi', '--port', str(port), '--workers', str(workers)]
+    if reuse_port:
+        command.append('--reuse-port')
+    if not sendfile:
+        command.append('--no-sendfile')
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_listening(port)
+    except Exception:
+        server.terminate()
+        raise
+    return server, port
+
+
+def drive(port, path, requests, concurrency):
+    # Keep-alive clients issuing `requests` GETs in total
+    remaining = [requests]
+    latencies = []
+    lock = threading.Lock()
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            start = time.perf_counter()
+            connection.request('GET', path)
+            connection.getresponse().read()
+            latencies.append(time.perf_counter() - start)
+        connection.close()
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def bench_load(app, repeat):
+    paths = {'index': '/', 'dynamic': '/dynamic/index', 'not_found': '/wp-login.php'}
+    results = {}
+
+    client = app.test_client()
+    for label, path in paths.items():
+        client.get(path)
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(repeat):
+            started = time.perf_counter()
+            client.get(path)
+            latencies.append(time.perf_counter() - started)
+        results[f'inprocess_{label}'] = summarize(latencies, time.perf_counter() - start)
+
+    server, port = serve(workers=1)
+    try:
+        for label, path in paths.items():
+            drive(port, path, 16, 16)
+            results[f'socket_{label}'] = drive(port, path, repeat, 16)
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def peak_rss_kib(pid):
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return None
+
+
+def bench_static(app, repeat):
+    # Files from static-templates, written for the run and removed afterwards
+    files = {'small': 16 * 1024, 'large': 8 * 1024 * 1024}
+    paths = {}
+    for label, size in files.items():
+        paths[label] = os.path.join(app.config['STATIC_TEMPLATES_PATH'], f'benchmark-{label}.bin')
+        with open(paths[label], 'wb') as file:
+            file.write(os.urandom(size))
+
+    static_files = app.extensions['static_files']
+    results = {}
+    try:
+        client = app.test_client()
+        max_file_size = static_files.max_file_size
+        for label, cached in (('memory', True), ('disk', False)):
+            static_files.max_file_size = max_file_size if cached else 0
+            client.get('/benchmark-small.bin')
+            latencies = []
+            start = time.perf_counter()
+            for _ in range(repeat):
+                started = time.perf_counter()
+                client.get('/benchmark-small.bin').close()
+                latencies.append(time.perf_counter() - started)
+            results[f'small_{label}'] = summarize(latencies, time.perf_counter() - start)
+        static_files.max_file_size = max_file_size
+
+        for label, sendfile in (('sendfile', True), ('copy', False)):
+            server, port = serve(workers=0, sendfile=sendfile)
+            try:
+                drive(port, '/benchmark-large.bin', 4, 4)
+                result = drive(port, '/benchmark-large.bin', max(20, repeat // 50), 4)
+                result['mib_per_s'] = result['requests_per_s'] * files['large'] / 1024 ** 2
+                result['peak_rss_kib'] = peak_rss_kib(server.pid)
+                results[f'large_{label}'] = result
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        for path in paths.values():
+            os.remove(path)
+    return results
+
+
+def bench_cache(app, repeat):
+    # Lookups of a rendered page sized value in each tier of the tiered cache
+    backend = app.extensions['cache'][cache]
+    if not hasattr(backend, 'l1'):
+        # CACHE_TYPE is a single tier backend
+        return {}
+    value = (os.urandom(32 * 1024), 'text/html')
+    with app.app_context():
+        cache.set('benchmark', value)
+
+        def l2_hit():
+            backend.l1.pop('benchmark')
+            return backend.get('benchmark')
+
+        results = {
+            'get': {
+                'l1_hit_us': measure(lambda: backend.get('benchmark'), repeat),
+                'l2_hit_us': measure(l2_hit, repeat),
+                'miss_us': measure(lambda: backend.get('benchmark-missing'), repeat),
+            },
+            'set': {
+                'set_us': measure(lambda: cache.set('benchmark', value), max(100, repeat // 10)),
+            },
+        }
+        cache.delete('benchmark')
+    return results
+
+
+def bench_images(app, repeat):
+    # A 2400x1600 photo-like JPEG under STATIC_IMAGES_PATH, resized to 640 in each format
+    if Image is None:
+        return {}
+    image_derivatives = app.extensions['image_derivatives']
+    path = os.path.join(app.config['STATIC_IMAGES_PATH'], 'benchmark.jpg')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.effect_noise((2400, 1600), 32).convert('RGB').save(path, quality=90)
+    original = os.path.getsize(path)
+
+    results = {}
+    client = app.test_client()
+    try:
+        for format in ['jpeg'] + image_derivatives.formats:
+            url = f'/images/benchmark.jpg?w=640&fm={format}'
+            target = image_derivatives.target_for('benchmark.jpg', os.stat(path), 640, image_derivatives.quality, format)
+
+            def miss():
+                if os.path.exists(target):
+                    os.remove(target)
+                client.get(url).close()
+
+            results[format] = {
+                'miss_us': measure(miss, max(3, repeat // 500)),
+                'hit_us': measure(lambda: client.get(url).close(), repeat),
+                'bytes': os.path.getsize(target),
+                'original_bytes': original,
+            }
+    finally:
+        os.remove(path)
+    return results
+
+
+def bench_herd(app, repeat, concurrency=32, render_delay=0.05):
+    # `concurrency` simultaneous requests for one cached page, missing then
+    # expired, each render made `render_delay` seconds slower
+    renders = []
+
+    def rendered(sender, template, context, **extra):
+        renders.append(template.name)
+        time.sleep(render_delay)
+
+    def burst():
+        barrier = threading.Barrier(concurrency)
+        latencies = []
+
+        def client():
+            with app.test_client() as client:
+                barrier.wait()
+                start = time.perf_counter()
+                assert client.get('/').status_code == 200
+                latencies.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=client) for _ in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return latencies, time.perf_counter() - start
+
+    saved = page_cache.enabled, page_cache.default_timeout, page_cache.timeouts
+    page_cache.enabled, page_cache.default_timeout, page_cache.timeouts = True, 1, {}
+    template_rendered.connect(rendered, app)
+    results = {}
+    try:
+        cache.clear()
+        latencies, elapsed = burst()
+        results['missing'] = dict(summarize(latencies, elapsed), renders=len(renders))
+
+        # past the timeout the burst is served stale while one refresh runs
+        time.sleep(1.1)
+        del renders[:]
+        latencies, elapsed = burst()
+        time.sleep(render_delay * 4)
+        results['expired'] = dict(summarize(latencies, elapsed), renders=len(renders))
+    finally:
+        template_rendered.disconnect(rendered, app)
+        page_cache.enabled, page_cache.default_timeout, page_cache.timeouts = saved
+        cache.clear()
+    return results
+
+
+STARTUP = '''
+import time
+start = time.perf_counter()
+import {package}
+imported = time.perf_counter()
+{package}.init_app()
+print(imported - start, time.perf_counter() - imported)
+'''
+
+
+def bench_startup(app, repeat):
+    # Cold interpreters, as a freshly deployed or respawned process
+    imports, inits = [], []
+    for _ in range(max(5, min(repeat // 100, 30))):
+        output = subprocess.check_output(
+            [sys.executable, '-c', STARTUP.format(package=__package__)], stderr=subprocess.DEVNULL,
+        )
+        imported, initialized = map(float, output.split())
+        imports.append(imported)
+        inits.append(initialized)
+    return {
+        'process': {
+            'import_us': percentile(imports, 50) * 1e6,
+            'init_app_us': percentile(inits, 50) * 1e6,
+            'total_us': percentile([a + b for a, b in zip(imports, inits)], 50) * 1e6,
+        },
+    }
+
+
+def bench_workers(app, repeat):
+    results = {}
+    for workers in (1, 2, 4):
+        for reuse_port in (False, True):
+            server, port = serve(workers, reuse_port)
+            try:
+                drive(port, '/', workers * 8, workers * 8)
+                label = f'{workers}_workers' + ('_reuse_port' if reuse_port else '')
+                results[label] = drive(port, '/', repeat, 16)
+            finally:
+                server.terminate()
+                server.wait()
+    return results
+
+
+BENCHMARKS = {
+    'cache': bench_cache,
+    'filters': bench_filters,
+    'herd': bench_herd,
+    'images': bench_images,
+    'load': bench_load,
+    'mail': bench_mail,
+    'mime': bench_mime,
+    'minify': bench_minify,
+    'render': bench_render,
+    'routing': bench_routing,
+    'startup': bench_startup,
+    'static': bench_static,
+    'streaming': bench_streaming,
+    'workers': bench_workers,
+}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def regressions(results, baseline, threshold):
+    """
+    (metric, before, after) for every latency or throughput in `results`
+    worse than in `baseline` by more than `threshold`
+    """
+    found = []
+    for name, labels in results.items():
+        for label, metrics in labels.items():
+            for key, value in metrics.items():
+                before = baseline.get(name, {}).get(label, {}).get(key)
+                if not before:
+                    continue
+                if key.endswith('_us'):
+                    change = value / before - 1
+                elif key.endswith('_per_s'):
+                    change = before / value - 1 if value else float('inf')
+                else:
+                    continue
+                if change > threshold:
+                    found.append((f'{name}.{label}.{key}', before, value))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('names', nargs='*', default=sorted(BENCHMARKS), choices=sorted(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as a regression, default 0.1')
+    args = parser.parse_args(argv)
+
+    app = init_app()
+    results = {}
+    for name in args.names:
+        results[name] = BENCHMARKS[name](app, args.repeat)
+        for label, timings in results[name].items():
+            row = '  '.join(f'{key}={value:.1f}' for key, value in timings.items())
+            print(f'{name}.{label}: {row}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'revision': git_revision(),
+                'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'repeat': args.repeat,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline['results'], args.threshold)
+        for metric, before, after in found:
+            print(f'REGRESSION {metric}: {before:.1f} -> {after:.1f}')
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
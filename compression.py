@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+import os
+import gzip
+import zlib
+import hashlib
+import mimetypes
+
+from flask import request, send_file, current_app
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+from .lru import LRUCache
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+
+SUFFIXES = {
+    'br': '.br',
+    'gzip': '.gz',
+}
+
+
+class Compressor(object):
+    """
+    negotiate Accept-Encoding, compress rendered bodies and serve
+    precompressed .br/.gz siblings of static files
+    """
+
+    def __init__(self, files=None, app=None):
+        self.files = files
+        self.enabled = False
+        self.min_size = 0
+        self.level = 6
+        self.brotli_quality = 5
+        self.mimetypes = frozenset()
+        self.encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+        self.cache = LRUCache()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('COMPRESS_ENABLED', False)
+        self.min_size = app.config.get('COMPRESS_MIN_SIZE', 500)
+        self.level = app.config.get('COMPRESS_LEVEL', 6)
+        self.brotli_quality = app.config.get('COMPRESS_BROTLI_QUALITY', 5)
+        self.mimetypes = frozenset(app.config.get('COMPRESS_MIMETYPES') or ())
+        self.cache = LRUCache(
+            max_entries=app.config.get('COMPRESS_CACHE_MAX_ENTRIES', 1024),
+            max_bytes=app.config.get('COMPRESS_CACHE_MAX_BYTES'),
+        )
+
+        if app.has_static_folder:
+            app.view_functions['static'] = self.send_static_file
+
+        app.extensions['compressor'] = self
+
+    def negotiate(self):
+        return request.accept_encodings.best_match(self.encodings)
+
+    def compress(self, body, encoding):
+        # Keyed on the body itself, so page and minify cache hits reuse the entry
+        key = (hashlib.blake2b(body, digest_size=16).digest(), encoding)
+        compressed = self.cache.get(key)
+        if compressed is None:
+            if encoding == 'br':
+                compressed = brotli.compress(body, quality=self.brotli_quality)
+            else:
+                compressed = gzip.compress(body, compresslevel=self.level, mtime=0)
+            self.cache.set(key, compressed)
+        return compressed
+
+    def compress_response(self, response):
+        if not self.enabled or response.mimetype not in self.mimetypes:
+            return response
+
+        response.vary.add('Accept-Encoding')
+
+        if response.direct_passthrough or response.status_code != 200 \
+                or 'Content-Encoding' in response.headers:
+            return response
+
+        if response.is_streamed:
+            return self.compress_streamed(response)
+
+        body = response.get_data()
+        if len(body) < self.min_size:
+            return response
+
+        encoding = self.negotiate()
+        if encoding is None:
+            return response
+
+        response.set_data(self.compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+
+        # a strong ETag must differ between the encoded variants
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f'{etag}-{encoding}', weak)
+        return response
+
+    def compress_streamed(self, response):
+        encoding = self.negotiate()
+        if encoding is None:
+            return response
+
+        original = response.response
+        if hasattr(original, 'close'):
+            response.call_on_close(original.close)
+        response.response = self.compress_chunks(response.iter_encoded(), encoding)
+        response.headers['Content-Encoding'] = encoding
+        response.headers.pop('Content-Length', None)
+
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f'{etag}-{encoding}', weak)
+        return response
+
+    def compress_chunks(self, chunks, encoding):
+        """
+        compress a stream of bytes, flushing after every chunk so each one
+        reaches the client as soon as it is rendered
+        """
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=self.brotli_quality)
+            for chunk in chunks:
+                data = compressor.process(chunk) + compressor.flush()
+                if data:
+                    yield data
+            yield compressor.finish()
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            for chunk in chunks:
+                data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                if data:
+                    yield data
+            yield compressor.flush()
+
+    def send_file(self, path, mimetype=None, **kwargs):
+        """
+        send_file preferring a .br/.gz sibling of `path` which is not older
+        than the file itself
+        """
+        if mimetype is None:
+            mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+        if not self.enabled:
+            return self._send_file(path, mimetype=mimetype, **kwargs)
+
+        source_mtime = os.stat(path).st_mtime_ns
+        # precompressed .br files need no brotli module to be served
+        accepted = [encoding for encoding in SUFFIXES if request.accept_encodings[encoding]]
+        candidates = [(encoding, path + SUFFIXES[encoding]) for encoding in SUFFIXES]
+        available = [(encoding, candidate) for encoding, candidate in candidates
+                     if os.path.isfile(candidate) and os.stat(candidate).st_mtime_ns >= source_mtime]
+
+        for encoding, candidate in available:
+            if encoding in accepted:
+                response = self._send_file(candidate, mimetype=mimetype, **kwargs)
+                response.headers['Content-Encoding'] = encoding
+                response.vary.add('Accept-Encoding')
+                return response
+
+        response = self._send_file(path, mimetype=mimetype, **kwargs)
+        if available or mimetype in self.mimetypes:
+            response.vary.add('Accept-Encoding')
+        return response
+
+    def _send_file(self, path, **kwargs):
+        # small hot files come from memory, the rest goes out with sendfile
+        if self.files is None:
+            return send_file(path, **kwargs)
+        return self.files.send_file(path, **kwargs)
+
+    def send_from_directory(self, directory, filename, **kwargs):
+        path = safe_join(directory, filename)
+        if path is None or not os.path.isfile(path):
+            raise NotFound()
+        return self.send_file(path, **kwargs)
+
+    def send_static_file(self, filename):
+        max_age = current_app.get_send_file_max_age(filename)
+        return self.send_from_directory(current_app.static_folder, filename, max_age=max_age)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Greenlet or thread primitives, whichever matches how the process runs.
+
+Under a gevent monkey-patched process background work is spawned as
+greenlets, otherwise as daemon threads.
+"""
+
+import sys
+import queue
+import threading
+
+
+def gevent_patched():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+def in_greenlet():
+    # pywsgi runs every request in a greenlet, monkey-patched or not
+    gevent = sys.modules.get('gevent')
+    return gevent is not None and isinstance(gevent.getcurrent(), gevent.Greenlet)
+
+
+def spawn(func, *args, **kwargs):
+    if gevent_patched():
+        import gevent
+        return gevent.spawn(func, *args, **kwargs)
+
+    thread = threading.Thread(target=func, args=args, kwargs=kwargs, daemon=True)
+    thread.start()
+    return thread
+
+
+def spawn_cooperative(func, *args, **kwargs):
+    """
+    spawn next to the caller, as a greenlet when it runs in one; for work
+    that does not block on unpatched I/O
+    """
+    if gevent_patched() or in_greenlet():
+        import gevent
+        return gevent.spawn(func, *args, **kwargs)
+    return spawn(func, *args, **kwargs)
+
+
+def spawn_later(seconds, func, *args, **kwargs):
+    if gevent_patched():
+        import gevent
+        return gevent.spawn_later(seconds, func, *args, **kwargs)
+
+    timer = threading.Timer(seconds, func, args=args, kwargs=kwargs)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def wait(future, timeout=None):
+    """
+    result of a concurrent.futures future, blocking only the calling
+    greenlet when gevent is not monkey-patched
+    """
+    if in_greenlet() and not gevent_patched():
+        import gevent
+        return gevent.get_hub().threadpool.apply(future.result, (timeout,))
+    return future.result(timeout)
+
+
+def Queue(maxsize=0):
+    if gevent_patched():
+        import gevent.queue
+        return gevent.queue.Queue(maxsize)
+    return queue.Queue(maxsize)
+
+
+def Event():
+    # waited on and set by request greenlets when served by pywsgi
+    if gevent_patched() or in_greenlet():
+        import gevent.event
+        return gevent.event.Event()
+    return threading.Event()
+
+
+Empty = queue.Empty
+Full = queue.Full
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+from fnmatch import fnmatch
+
+from flask import request, g, make_response
+from werkzeug.http import http_date
+
+
+class ConditionalPages(object):
+    """
+    ETag/Last-Modified validators and Cache-Control for rendered templates,
+    answering 304 before rendering when the validators can be known upfront
+    """
+
+    def __init__(self, page_cache=None, analyzer=None, app=None):
+        self.page_cache = page_cache
+        self.analyzer = analyzer
+        self.enabled = False
+        self.cache_control = {}
+        self.encodings = ()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('CONDITIONAL_PAGES_ENABLED', False)
+        self.cache_control = app.config.get('CACHE_CONTROL') or {}
+        compressor = app.extensions.get('compressor')
+        self.encodings = tuple(compressor.encodings) if compressor else ()
+
+        app.extensions['conditional_pages'] = self
+
+    def cache_control_for(self, name):
+        for pattern, value in self.cache_control.items():
+            if fnmatch(name, pattern):
+                return value
+        return None
+
+    def matches(self, etag):
+        """
+        the variant of `etag` the client already holds, if any
+        """
+        # the compressor suffixes the ETag of the variants it produces
+        for candidate in (etag,) + tuple(f'{etag}-{encoding}' for encoding in self.encodings):
+            if request.if_none_match.contains(candidate):
+                return candidate
+        return None
+
+    def precondition(self, name):
+        """
+        304 response for template `name` when the client copy is still
+        valid, otherwise None after noting the validators for finalize
+        """
+        g.conditional_template = name
+        if not self.enabled or request.method not in ('GET', 'HEAD'):
+            return None
+
+        key = self.page_cache.key_for(name)
+        if key is None:
+            return None
+
+        # the page cache key changes with every input of the page
+        etag = key.rsplit(':', 1)[1]
+        last_modified = self.page_cache.last_modified(name)
+        g.conditional_etag = etag
+        g.conditional_last_modified = last_modified
+
+        if request.if_none_match:
+            matched = self.matches(etag)
+        elif last_modified is not None and request.if_modified_since is not None \
+                and int(last_modified) <= request.if_modified_since.timestamp():
+            matched = etag
+        else:
+            matched = None
+        if matched is None:
+            return None
+
+        response = make_response('', 304)
+        self._set_headers(response, name, matched, last_modified)
+        return response
+
+    def finalize(self, response):
+        name = g.get('conditional_template')
+        if name is None or not self.enabled:
+            return response
+
+        if response.status_code != 200 or response.direct_passthrough \
+                or request.method not in ('GET', 'HEAD'):
+            return response
+
+        etag = g.get('conditional_etag')
+        if response.is_streamed:
+            # no body to hash, only validators known before rendering apply
+            if etag is not None:
+                self._set_headers(response, name, etag, g.get('conditional_last_modified'))
+            return response
+
+        if etag is None:
+            # not known before rendering, hash the final body
+            response.add_etag()
+            etag = response.get_etag()[0]
+
+        self._set_headers(response, name, etag, g.get('conditional_last_modified'))
+
+        matched = self.matches(etag)
+        if matched is not None:
+            response.status_code = 304
+            response.set_data(b'')
+            response.set_etag(matched)
+        return response
+
+    def _set_headers(self, response, name, etag, last_modified):
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.headers['Last-Modified'] = http_date(last_modified)
+        self.set_cache_control(response, name)
+
+    def set_cache_control(self, response, name):
+        """
+        Cache-Control configured for template `name`, also on the built
+        artifacts of it send_file answers with
+        """
+        cache_control = self.cache_control_for(name)
+        if self.enabled and cache_control:
+            response.headers['Cache-Control'] = cache_control
+        return response
@@ -1,8 +1,8 @@
 from datetime import timedelta
 from os import environ, path
 import secrets
-import ast
 
+from . import constants
 from .constants import *
 
 
@@ -55,6 +55,15 @@ class BaseConfig(object):
     HOST = "127.0.0.1"
     PORT = 80
 
+    # wsgi.py server, WSGI_WORKERS None forks one worker per CPU
+    WSGI_HOST = environ.get('WSGI_HOST') or '127.0.0.1'
+    WSGI_PORT = int(environ.get('WSGI_PORT') or 5000)
+    WSGI_WORKERS = int(environ['WSGI_WORKERS']) if environ.get('WSGI_WORKERS') else None
+    WSGI_REUSE_PORT = False
+    WSGI_GRACEFUL_TIMEOUT = 30
+    # Files from send_file go from the page cache to the socket with os.sendfile
+    WSGI_SENDFILE = True
+
     APP_NAME = 'flask'
 
     PROJECT = "portale"
@@ -127,6 +136,132 @@ class BaseConfig(object):
     WTF_CSRF_ENABLED = False
 
     CACHE_NO_NULL_WARNING = True
+    CACHE_DEFAULT_TIMEOUT = 300
+    # Per process LRU (L1) in front of a cache shared by the workers (L2), any Flask-Caching
+    # backend, eg. 'RedisCache' with CACHE_REDIS_URL for several hosts. Writes tell the other
+    # processes to drop their L1 copy, CACHE_L1_TIMEOUT bounds how stale one can get otherwise.
+    CACHE_TYPE = f'{__package__}.tiered_cache.TieredCache'
+    CACHE_L2_TYPE = 'FileSystemCache'
+    CACHE_THRESHOLD = 2000
+    CACHE_L1_MAX_ENTRIES = 512
+    CACHE_L1_TIMEOUT = 30
+    CACHE_L1_SYNC_INTERVAL = 0.1
+    CACHE_INVALIDATION_LOG_SIZE = 1024 * 1024
+
+    # Rendered GET pages, timeouts in seconds by template name pattern (0 skips the page)
+    PAGE_CACHE_ENABLED = False
+    PAGE_CACHE_DEFAULT_TIMEOUT = 300
+    PAGE_CACHE_TIMEOUTS = {
+        'mails/*': 0,
+        'http_statuses/*': 0,
+    }
+    # Seconds an expired page is still served while it is rendered again in the background,
+    # and the longest a request waits for another one rendering the same page
+    PAGE_CACHE_STALE_GRACE = 60
+    PAGE_CACHE_LOCK_TIMEOUT = 10
+
+    # {% cache key, timeout %} fragments, timeout None uses FRAGMENT_CACHE_DEFAULT_TIMEOUT
+    FRAGMENT_CACHE_ENABLED = True
+    FRAGMENT_CACHE_DEFAULT_TIMEOUT = 300
+
+    # Seconds between directory mtime scans of the route index, None never rescans
+    ROUTE_INDEX_REFRESH_INTERVAL = 1
+
+    # Entries of the (path, mtime, size) -> mime type cache
+    MIME_CACHE_SIZE = 1024
+
+    # Minify html when templates are compiled, on every response or not at all:
+    # 'compile', 'response' or 'off'
+    MINIFY_MODE = 'off'
+    MINIFY_REMOVE_COMMENTS = True
+    MINIFY_EXCLUDE = ['mails/*']
+
+    # ETag/Last-Modified on rendered templates, Cache-Control by template name pattern
+    CONDITIONAL_PAGES_ENABLED = True
+    CACHE_CONTROL = {
+        'http_statuses/*': 'no-store',
+        '*': 'no-cache',
+    }
+
+    # Serve pages pre-rendered by `flask build-site` from BUILD_PATH
+    SITE_BUILD_SERVE = True
+    SITE_BUILD_EXCLUDE = ['mails/*']
+
+    # gzip/brotli responses, compressed bodies are cached by content hash
+    COMPRESS_ENABLED = True
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_LEVEL = 6
+    COMPRESS_BROTLI_QUALITY = 5
+    COMPRESS_MIMETYPES = [
+        'text/html',
+        'text/css',
+        'text/plain',
+        'text/javascript',
+        'application/javascript',
+        'application/json',
+        'image/svg+xml',
+        'image/vnd.microsoft.icon',
+    ]
+    COMPRESS_CACHE_MAX_ENTRIES = 1024
+    COMPRESS_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+    # Static files up to STATIC_CACHE_MAX_FILE_SIZE are kept in memory until their mtime changes,
+    # larger ones go out with sendfile when served by wsgi.py
+    STATIC_CACHE_MAX_FILE_SIZE = 64 * 1024
+    STATIC_CACHE_MAX_ENTRIES = 1024
+    STATIC_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+    # asset_url links files under STATIC_PATH by content hash, served from ASSETS_URL as immutable;
+    # ASSETS_AUTO_REFRESH re-hashes a file whose mtime changed when a page links it
+    ASSETS_BUILD_ON_STARTUP = True
+    ASSETS_AUTO_REFRESH = True
+    ASSETS_MAX_AGE = 365 * 24 * 3600
+
+    # Link: rel=preload headers for the stylesheets, blocking scripts and preloads of each
+    # template, sent ahead as 103 Early Hints when the server supports them
+    PRELOAD_HINTS_ENABLED = True
+    PRELOAD_EARLY_HINTS = True
+    PRELOAD_HINTS_MAX = 8
+    PRELOAD_HINTS_EXCLUDE = ['mails/*', 'http_statuses/*']
+
+    # Images under STATIC_IMAGES_PATH resized to the nearest IMAGE_WIDTHS and converted to the first
+    # of IMAGE_FORMATS the browser accepts, in a pool of IMAGE_WORKERS processes (None: one per CPU);
+    # the derivatives are kept in IMAGE_CACHE_PATH, least recently used dropped past IMAGE_CACHE_MAX_BYTES
+    IMAGE_WIDTHS = [320, 640, 960, 1280, 1920]
+    IMAGE_FORMATS = ['avif', 'webp']
+    IMAGE_QUALITY = 80
+    # the q argument is rounded up to one of these, with IMAGE_QUALITY
+    IMAGE_QUALITIES = [50, 65, 90]
+    IMAGE_WORKERS = 2
+    IMAGE_TIMEOUT = 30
+    IMAGE_MAX_PIXELS = 40 * 1000 * 1000
+    IMAGE_MAX_AGE = 7 * 24 * 3600
+    IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+    # Memoized htmlmin output, bodies above MINIFY_CACHE_MAX_BODY_SIZE are minified uncached
+    MINIFY_CACHE_MAX_ENTRIES = 1024
+    MINIFY_CACHE_MAX_BYTES = 16 * 1024 * 1024
+    MINIFY_CACHE_MAX_BODY_SIZE = 1024 * 1024
+
+    # Stream the templates matching STREAM_TEMPLATES, and any page whose last render
+    # was at least STREAM_MIN_SIZE characters (None never switches automatically)
+    STREAM_TEMPLATES = []
+    STREAM_MIN_SIZE = 256 * 1024
+    STREAM_BUFFER_SIZE = 8192
+
+    # Compile every template on startup, before the workers accept connections; READINESS_URL
+    # answers 200 once a worker serves (None disables it).
+    # Set TEMPLATE_BYTECODE_CACHE_PATH to None to keep compiled templates in memory only
+    TEMPLATE_WARMUP = False
+    READINESS_URL = None
+
+    # Opt-in Prometheus metrics at METRICS_URL, summed over the workers' snapshots
+    METRICS_ENABLED = False
+    METRICS_URL = '/metrics'
+    METRICS_FLUSH_INTERVAL = 5
+    METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    # Server-Timing header with the duration of every stage of the request
+    METRICS_SERVER_TIMING = False
 
     RANDOM_WALLPAPER_LOGIN = False
 
@@ -164,6 +299,25 @@ class BaseConfig(object):
 
     EMAIL_SEND = False
 
+    # reCAPTCHA siteverify, the breaker fails closed for COOLDOWN seconds after THRESHOLD failures
+    RECAPTCHA_VERIFY_URL = 'https://www.google.com/recaptcha/api/siteverify'
+    RECAPTCHA_CONNECT_TIMEOUT = 1.0
+    RECAPTCHA_READ_TIMEOUT = 2.0
+    RECAPTCHA_POOL_SIZE = 4
+    RECAPTCHA_BREAKER_THRESHOLD = 5
+    RECAPTCHA_BREAKER_COOLDOWN = 30
+    RECAPTCHA_VERDICT_TTL = 120
+    RECAPTCHA_VERDICT_CACHE_SIZE = 10000
+
+    # Background delivery of the contact form mails over persistent SMTP connections
+    MAIL_QUEUE_ENABLED = True
+    MAIL_QUEUE_WORKERS = 2
+    MAIL_QUEUE_BATCH_SIZE = 20
+    MAIL_QUEUE_SIZE = 1000
+    MAIL_QUEUE_MAX_RETRIES = 5
+    MAIL_QUEUE_RETRY_BACKOFF = 1.0
+    MAIL_QUEUE_IDLE_TIMEOUT = 30
+
 
 class Development(BaseConfig):
     ''' Development config. '''
@@ -191,6 +345,14 @@ class Production(Staging):
 
     JSONIFY_PRETTYPRINT_REGULAR = False
 
+    ROUTE_INDEX_REFRESH_INTERVAL = 30
+
+    MINIFY_MODE = 'compile'
+
+    TEMPLATE_WARMUP = True
+
+    ASSETS_AUTO_REFRESH = False
+
     SQLALCHEMY_TRACK_MODIFICATIONS=False
     SECURITY_REGISTERABLE=False
 
@@ -203,19 +365,7 @@ configurations = {
 
 config = configurations[APPLICATION_ENV]
 
-with open('constants.py', 'r') as file:
-    content = file.read()
-
-tree = ast.parse(content)
-
-for node in ast.walk(tree):
-    if isinstance(node, ast.Assign):
-        for target in node.targets:
-            if isinstance(target, ast.Name):
-                var_name = target.id
-                var_value = None
-                if var_name in globals():
-                    var_value = globals()[var_name]
-                elif var_name in locals():
-                    var_value = locals()[var_name]
-                setattr(config, var_name, var_value)
+# Every constant is also reachable as a config attribute
+for name in dir(constants):
+    if name.isupper():
+        setattr(config, name, getattr(constants, name))
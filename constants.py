@@ -1,7 +1,7 @@
 import pytz
 
 import pathlib
-from os import environ, path, makedirs # , getuid, getgid
+from os import environ, path # , getuid, getgid
 
 WEBSITE = environ.get('WEBSITE') or 'www.example.com'
     
@@ -31,16 +31,34 @@ APPLICATION_PATH = pathlib.Path(__file__).parent.resolve()
 BASE_PATH = path.dirname(path.abspath(__file__))
 INSTANCE_FOLDER_PATH = path.abspath(path.join(BASE_PATH, '..'))
 STATIC_PATH = path.join(BASE_PATH, 'static')
-makedirs(STATIC_PATH, 0o777, exist_ok=True)
 
 TEMPLATES_PATH = path.join(BASE_PATH, 'templates')
-makedirs(TEMPLATES_PATH, 0o777, exist_ok=True)
 
 STATIC_TEMPLATES_PATH = path.join(BASE_PATH, 'static-templates')
-makedirs(STATIC_TEMPLATES_PATH, 0o777, exist_ok=True)
 
 STATIC_IMAGES_PATH = path.join(STATIC_PATH, 'images')
-makedirs(STATIC_IMAGES_PATH, 0o777, exist_ok=True)
+
+# Output of `flask build-site`, created by the command itself
+BUILD_PATH = path.join(INSTANCE_FOLDER_PATH, 'build')
+
+# Compiled templates shared by the workers, created on startup
+TEMPLATE_BYTECODE_CACHE_PATH = path.join(INSTANCE_FOLDER_PATH, 'jinja-cache')
+
+# Content hashes of the files under STATIC_PATH, written on startup and by `flask build-assets`
+ASSETS_MANIFEST_PATH = path.join(INSTANCE_FOLDER_PATH, 'assets.json')
+
+# L2 of the tiered cache shared by the workers, and the log telling them which L1 entries to drop
+CACHE_DIR = path.join(INSTANCE_FOLDER_PATH, 'cache')
+CACHE_INVALIDATION_LOG = path.join(INSTANCE_FOLDER_PATH, 'cache-invalidations.log')
+
+# Key prefixes invalidated in the fragment cache, one line per invalidation
+FRAGMENT_GENERATIONS_LOG = path.join(INSTANCE_FOLDER_PATH, 'fragment-generations.log')
+
+# Resized and converted copies of the files under STATIC_IMAGES_PATH, pruned to IMAGE_CACHE_MAX_BYTES
+IMAGE_CACHE_PATH = path.join(INSTANCE_FOLDER_PATH, 'image-cache')
+
+# Per worker metrics snapshots, created when metrics are enabled
+METRICS_DIRECTORY = path.join(INSTANCE_FOLDER_PATH, 'metrics')
 
 PATHS = {
     'APPLICATION_PATH': APPLICATION_PATH,
@@ -50,18 +68,32 @@ PATHS = {
     'STATIC_IMAGES_PATH': STATIC_IMAGES_PATH,
     'TEMPLATES_PATH': TEMPLATES_PATH,
     'STATIC_TEMPLATES_PATH': STATIC_TEMPLATES_PATH,
+    'BUILD_PATH': BUILD_PATH,
+    'METRICS_DIRECTORY': METRICS_DIRECTORY,
+    'TEMPLATE_BYTECODE_CACHE_PATH': TEMPLATE_BYTECODE_CACHE_PATH,
+    'ASSETS_MANIFEST_PATH': ASSETS_MANIFEST_PATH,
+    'CACHE_DIR': CACHE_DIR,
+    'CACHE_INVALIDATION_LOG': CACHE_INVALIDATION_LOG,
+    'FRAGMENT_GENERATIONS_LOG': FRAGMENT_GENERATIONS_LOG,
+    'IMAGE_CACHE_PATH': IMAGE_CACHE_PATH,
 }
 
 # URLs
 BASE_URL = '/'
 STATIC_URL = path.join(BASE_URL, 'static')
 STATIC_IMAGES_URL = path.join(STATIC_URL, 'images')
+# Fingerprinted copies of STATIC_URL, see asset_url
+ASSETS_URL = path.join(BASE_URL, 'assets')
+# Derivatives of STATIC_IMAGES_URL, see image_srcset
+IMAGES_URL = path.join(BASE_URL, 'images')
 ADMIN_URL_PREFIX = ''
 
 URLS = {
     'BASE_URL': BASE_URL,
     'STATIC_URL': STATIC_URL,
     'STATIC_IMAGES_URL': STATIC_IMAGES_URL,
+    'ASSETS_URL': ASSETS_URL,
+    'IMAGES_URL': IMAGES_URL,
 }
 
 #PROCESS_UID = getuid()
@@ -4,8 +4,63 @@ from flask_mail import Mail
 from flask_caching import Cache
 from flask_cors import CORS
 
+from .assets import Assets
+from .compression import Compressor
+from .conditional import ConditionalPages
+from .fragment_cache import FragmentCache
+from .image_derivatives import ImageDerivatives
+from .mail_queue import MailQueue
+from .metrics import Metrics
+from .mime import MimeDetector
+from .recaptcha import RecaptchaVerifier
+from .minify_cache import MinifyCache
+from .page_cache import PageCache
+from .preload import PreloadHints
+from .routing import RouteIndex
+from .site_build import SiteBuild
+from .static_files import StaticFiles
+from .streaming import StreamingPages
+from .template_analysis import TemplateAnalyzer
+from .template_warmup import TemplateWarmup
+
 cors = CORS()
 
+metrics = Metrics()
+
 mail = Mail()
 
-cache = Cache()
\ No newline at end of file
+mail_queue = MailQueue(mail)
+
+recaptcha = RecaptchaVerifier()
+
+cache = Cache()
+
+route_index = RouteIndex()
+
+mime_detector = MimeDetector()
+
+static_files = StaticFiles()
+
+compressor = Compressor(static_files)
+
+assets = Assets(compressor)
+
+template_analyzer = TemplateAnalyzer()
+
+page_cache = PageCache(cache, template_analyzer, assets)
+
+fragment_cache = FragmentCache(cache, template_analyzer, assets)
+
+minify_cache = MinifyCache()
+
+image_derivatives = ImageDerivatives(compressor)
+
+preload_hints = PreloadHints(template_analyzer, assets)
+
+site_build = SiteBuild(template_analyzer, route_index, assets)
+
+conditional_pages = ConditionalPages(page_cache, template_analyzer)
+
+template_warmup = TemplateWarmup()
+
+streaming_pages = StreamingPages()
\ No newline at end of file
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+
+from collections import Counter
+
+from flask import g, has_request_context
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+
+class FragmentCache(object):
+    """
+    rendered template fragments stored in the Flask-Caching `cache`, see
+    FragmentCacheExtension for the {% cache %} tag
+
+    The invalidated prefixes are appended to FRAGMENT_GENERATIONS_LOG rather
+    than kept in the cache, an eviction would bring back the fragments they
+    dropped.
+    """
+
+    def __init__(self, cache=None, analyzer=None, assets=None, app=None):
+        self.cache = cache
+        self.analyzer = analyzer
+        self.assets = assets
+        self.enabled = False
+        self.default_timeout = None
+        self.generations_log = None
+        self.hits = 0
+        self.misses = 0
+        # prefix -> invalidations, and the log file they were read from
+        self._generations = Counter()
+        self._generations_read = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('FRAGMENT_CACHE_ENABLED', False)
+        self.default_timeout = app.config.get('FRAGMENT_CACHE_DEFAULT_TIMEOUT')
+        self.generations_log = app.config.get('FRAGMENT_GENERATIONS_LOG')
+
+        app.extensions['fragment_cache'] = self
+
+    def _memo(self, name, factory):
+        # read once per request, every fragment of the page needs them
+        if not has_request_context():
+            return factory()
+        memo = g.setdefault('fragment_cache', {})
+        if name not in memo:
+            memo[name] = factory()
+        return memo[name]
+
+    def generations(self):
+        return self._memo('generations', self._read_generations)
+
+    def _read_generations(self):
+        # without a log the invalidations only reach this process
+        if not self.generations_log:
+            return self._generations
+        try:
+            stat = os.stat(self.generations_log)
+        except FileNotFoundError:
+            return Counter()
+        # appended to only, a new size means new lines
+        read = (self.generations_log, stat.st_ino, stat.st_size)
+        if read == self._generations_read:
+            return self._generations
+
+        with open(self.generations_log, 'rb') as file:
+            data = file.read(stat.st_size)
+        # a line still being written counts on the next read
+        generations = Counter(json.loads(line) for line in data[:data.rfind(b'\n') + 1].splitlines())
+        self._generations, self._generations_read = generations, read
+        return generations
+
+    def signature(self, template):
+        # mtimes of the template and of everything it includes or extends,
+        # and the asset hashes when it links assets
+        if template is None:
+            return ()
+        return self._memo(('signature', template), lambda: self._signature(self.analyzer.analyse(template)))
+
+    def _signature(self, info):
+        signature = self.analyzer.signature(info)
+        if self.assets is not None and 'asset_url' in info.context_names:
+            signature += (self.assets.version,)
+        return signature
+
+    def key_for(self, key, template, vary):
+        # a prefix invalidated after the fragment was stored changes its key
+        generations = sorted((prefix, generation) for prefix, generation in self.generations().items()
+                             if str(key).startswith(prefix))
+        digest = hashlib.blake2b(repr((template, self.signature(template), vary, generations)).encode('utf-8'),
+                                 digest_size=16)
+        return f'fragment:{key}:{digest.hexdigest()}'
+
+    def render(self, key, timeout, template, vary, caller):
+        if not self.enabled:
+            return caller()
+
+        cache_key = self.key_for(key, template, vary)
+        fragment = self.cache.get(cache_key)
+        if fragment is not None:
+            self.hits += 1
+            return fragment
+
+        self.misses += 1
+        fragment = caller()
+        self.cache.set(cache_key, fragment, timeout=self.default_timeout if timeout is None else timeout)
+        return fragment
+
+    def invalidate(self, prefix=''):
+        """
+        drop every fragment whose key starts with `prefix`, the entries are
+        left to expire
+        """
+        if not self.generations_log:
+            self._generations = self._generations + Counter({prefix: 1})
+        else:
+            os.makedirs(os.path.dirname(self.generations_log), exist_ok=True)
+            # one O_APPEND write per invalidation, concurrent ones from other workers all count
+            fd = os.open(self.generations_log, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, (json.dumps(prefix) + '\n').encode('utf-8'))
+            finally:
+                os.close(fd)
+        if has_request_context():
+            g.pop('fragment_cache', None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class FragmentCacheExtension(Extension):
+    """
+    {% cache key[, timeout[, vary, ...]] %}...{% endcache %} caches its body
+    by key, template, template mtime and the vary values
+    """
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        timeout = nodes.Const(None)
+        vary = []
+        if parser.stream.skip_if('comma'):
+            timeout = parser.parse_expression()
+            while parser.stream.skip_if('comma'):
+                vary.append(parser.parse_expression())
+        args += [timeout, nodes.Const(parser.name), nodes.Tuple(vary, 'load')]
+
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', args), [], [], body).set_lineno(lineno)
+
+    def _render(self, key, timeout, template, vary, caller):
+        fragment_cache = self.environment.fragment_cache
+        if fragment_cache is None:
+            return caller()
+        return fragment_cache.render(key, timeout, template, vary, caller)
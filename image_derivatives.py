@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import bisect
+import hashlib
+import logging
+import posixpath
+import threading
+
+from concurrent.futures import TimeoutError
+
+from flask import request, url_for
+from markupsafe import Markup
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+from . import concurrency
+from .lru import LRUCache
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+
+logger = logging.getLogger(__name__)
+
+# Output formats: Pillow plugin, mimetype and file extension
+FORMATS = {
+    'avif': ('AVIF', 'image/avif', '.avif'),
+    'webp': ('WEBP', 'image/webp', '.webp'),
+    'jpeg': ('JPEG', 'image/jpeg', '.jpg'),
+    'png': ('PNG', 'image/png', '.png'),
+}
+
+# Originals the endpoint derives from, the others are sent as they are
+SOURCES = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.png': 'png', '.webp': 'webp', '.avif': 'avif'}
+
+# EXIF tag _derive applies with exif_transpose
+ORIENTATION = 0x0112
+
+# Hits refresh the atime eviction goes by at most this often, in seconds
+TOUCH_INTERVAL = 3600
+
+
+def _derive(source, target, width, quality, format, max_pixels):
+    """
+    write `source` resized to at most `width` pixels across, in `format`,
+    to `target`; runs in the pool and returns the size written
+    """
+    with Image.open(source) as original:
+        if max_pixels and original.width * original.height > max_pixels:
+            raise ValueError(f'{source} has more than {max_pixels} pixels')
+        image = ImageOps.exif_transpose(original)
+        if width and image.width > width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        if format == 'jpeg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        elif image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode.endswith('A') else 'RGB')
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # write then rename, the other workers may be sending it
+        tmp = f'{target}.tmp{os.getpid()}'
+        image.save(tmp, FORMATS[format][0], quality=quality)
+        os.replace(tmp, target)
+    return os.path.getsize(target)
+
+
+def _prune(root, max_bytes):
+    """
+    remove the least recently used derivatives until the cache is back
+    under 90% of `max_bytes`, return what is left
+    """
+    entries = []
+    total = 0
+    for directory, _, files in os.walk(root):
+        for filename in files:
+            path = os.path.join(directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if '.tmp' in filename and stat.st_mtime > time.time() - TOUCH_INTERVAL:
+                # still being written
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+            total += stat.st_size
+
+    if total > max_bytes:
+        for _, size, path in sorted(entries):
+            if total <= max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+    return total
+
+
+class ImageDerivatives(object):
+    """
+    images under STATIC_IMAGES_PATH resized and converted on first request
+    from IMAGES_URL, kept on disk under IMAGE_CACHE_PATH; without Pillow the
+    originals are sent
+    """
+
+    def __init__(self, compressor=None, app=None):
+        self.compressor = compressor
+        self.root = None
+        self.cache_path = None
+        self.widths = []
+        self.formats = []
+        self.quality = 80
+        self.qualities = [80]
+        self.workers = None
+        self.timeout = None
+        self.max_pixels = None
+        self.max_age = None
+        self.max_bytes = None
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        # target path -> future of the derivative being written
+        self._futures = {}
+        # source path -> ((mtime_ns, size), (width, height))
+        self._dimensions = LRUCache(max_entries=1024)
+        self._usage = None
+        self._pruning = False
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.root = app.config.get('STATIC_IMAGES_PATH')
+        self.cache_path = app.config.get('IMAGE_CACHE_PATH')
+        self.widths = sorted(app.config.get('IMAGE_WIDTHS') or ())
+        self.quality = app.config.get('IMAGE_QUALITY', 80)
+        self.qualities = sorted(set(app.config.get('IMAGE_QUALITIES') or ()) | {self.quality})
+        self.workers = app.config.get('IMAGE_WORKERS')
+        self.timeout = app.config.get('IMAGE_TIMEOUT')
+        self.max_pixels = app.config.get('IMAGE_MAX_PIXELS')
+        self.max_age = app.config.get('IMAGE_MAX_AGE')
+        self.max_bytes = app.config.get('IMAGE_CACHE_MAX_BYTES')
+        self.formats = [format for format in app.config.get('IMAGE_FORMATS') or () if self.can_write(format)]
+
+        app.add_url_rule(f"{app.config.get('IMAGES_URL')}/<path:filename>", 'images', self.view)
+        app.extensions['image_derivatives'] = self
+
+    @staticmethod
+    def can_write(format):
+        # AVIF needs Pillow 11.3 or a plugin, WebP a libwebp build
+        if Image is None or format not in FORMATS:
+            return False
+        Image.init()
+        return FORMATS[format][0] in Image.SAVE
+
+    def width_for(self, requested):
+        # the next configured width up, a handful of derivatives per image
+        if not requested or requested <= 0 or not self.widths:
+            return None
+        index = bisect.bisect_left(self.widths, requested)
+        return self.widths[min(index, len(self.widths) - 1)]
+
+    def quality_for(self, requested):
+        # the next configured quality up, like the widths
+        if requested is None:
+            return self.quality
+        index = bisect.bisect_left(self.qualities, requested)
+        return self.qualities[min(index, len(self.qualities) - 1)]
+
+    def format_for(self, source_format):
+        """
+        the explicit fm argument, else the first of IMAGE_FORMATS the
+        browser lists in Accept; and whether the choice depends on Accept
+        """
+        requested = request.args.get('fm')
+        if requested in FORMATS and self.can_write(requested):
+            return requested, False
+        # only the types it names, every browser sends */* for images
+        accepted = {mimetype for mimetype, quality in request.accept_mimetypes if quality}
+        for format in self.formats:
+            if FORMATS[format][1] in accepted:
+                return format, True
+        return source_format if source_format in ('jpeg', 'png') else 'png', True
+
+    def target_for(self, filename, stat, width, quality, format):
+        key = repr((filename, stat.st_mtime_ns, stat.st_size, width, quality, format))
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+        # a new mtime means a new name, the old derivatives age out of the cache
+        return os.path.join(self.cache_path, digest[:2], digest[2:] + FORMATS[format][2])
+
+    def _executor(self):
+        # the pool belongs to the process that started it, a forked worker
+        # starts its own on first use
+        if self._pid == os.getpid():
+            return self._pool
+        with self._lock:
+            if self._pid != os.getpid():
+                # only processes serving images need a process pool
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                context = multiprocessing.get_context('fork') \
+                    if 'fork' in multiprocessing.get_all_start_methods() else None
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                self._futures = {}
+                self._pid = os.getpid()
+        return self._pool
+
+    def _submit(self, source, target, width, quality, format):
+        # one job per derivative, concurrent requests for it wait on the same future
+        executor = self._executor()
+        with self._lock:
+            future = self._futures.get(target)
+            if future is None:
+                future = executor.submit(_derive, source, target, width, quality, format, self.max_pixels)
+                self._futures[target] = future
+                future.add_done_callback(lambda done: self._written(target, done))
+        return future
+
+    def _written(self, target, future):
+        with self._lock:
+            self._futures.pop(target, None)
+            if future.cancelled() or future.exception() is not None:
+                return
+            if self._usage is not None:
+                self._usage += future.result()
+            if self._pruning or (self._usage is not None and self._usage <= self.max_bytes) \
+                    or not self.max_bytes:
+                return
+            self._pruning = True
+        # runs on the pool's management thread, hand the walk to a worker
+        self._executor().submit(_prune, self.cache_path, self.max_bytes).add_done_callback(self._pruned)
+
+    def _pruned(self, future):
+        with self._lock:
+            self._pruning = False
+            if not future.cancelled() and future.exception() is None:
+                self._usage = future.result()
+
+    def derivative(self, source, target, width, quality, format):
+        """
+        path of the derivative, written first when missing; None when it
+        cannot be made in IMAGE_TIMEOUT seconds
+        """
+        try:
+            stat = os.stat(target)
+        except FileNotFoundError:
+            pass
+        else:
+            self.hits += 1
+            now = time.time()
+            if now - stat.st_atime > TOUCH_INTERVAL:
+                # the mtime stays, it is the Last-Modified of the response
+                try:
+                    os.utime(target, ns=(time.time_ns(), stat.st_mtime_ns))
+                except OSError:
+                    pass
+            return target
+
+        self.misses += 1
+        try:
+            concurrency.wait(self._submit(source, target, width, quality, format), self.timeout)
+        except TimeoutError:
+            # left running, a later request finds it on disk
+            logger.warning('Image %s not resized in %s seconds', source, self.timeout)
+            return None
+        except Exception:
+            self.errors += 1
+            logger.exception('Cannot resize image %s', source)
+            return None
+        return target
+
+    def view(self, filename):
+        source = safe_join(self.root, filename)
+        if source is None or not os.path.isfile(source):
+            raise NotFound()
+
+        source_format = SOURCES.get(posixpath.splitext(filename)[1].lower())
+        if Image is None or source_format is None:
+            return self.compressor.send_file(source)
+
+        width = self.width_for(request.args.get('w', type=int))
+        quality = self.quality_for(request.args.get('q', type=int))
+        format, negotiated = self.format_for(source_format)
+
+        path = source
+        if width is not None or format != source_format or quality != self.quality:
+            stat = os.stat(source)
+            target = self.target_for(filename, stat, width, quality, format)
+            path = self.derivative(source, target, width, quality, format) or source
+
+        if path is source:
+            response = self.compressor.send_file(source)
+        else:
+            response = self.compressor.send_file(path, mimetype=FORMATS[format][1], max_age=self.max_age)
+            response.cache_control.public = True
+        if negotiated:
+            response.vary.add('Accept')
+        return response
+
+    def dimensions(self, filename):
+        """
+        (width, height) of `filename` under STATIC_IMAGES_PATH, read from its
+        header once per mtime; None when unknown
+        """
+        path = safe_join(self.root, filename)
+        if Image is None or path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        version = (stat.st_mtime_ns, stat.st_size)
+        entry = self._dimensions.get(path)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        try:
+            with Image.open(path) as image:
+                # the EXIF orientations turning the picture on its side
+                size = image.size[::-1] if image.getexif().get(ORIENTATION) in (5, 6, 7, 8) else image.size
+        except Exception:
+            size = None
+        self._dimensions.set(path, (version, size))
+        return size
+
+    def srcset(self, filename, widths=None):
+        """
+        srcset attribute value for `filename` under STATIC_IMAGES_PATH, one
+        candidate per width below its own plus the original width
+        """
+        size = self.dimensions(filename)
+        if size is None or SOURCES.get(posixpath.splitext(filename)[1].lower()) is None:
+            return ''
+        candidates = [width for width in sorted(widths or self.widths) if width < size[0]]
+        urls = [f"{url_for('images', filename=filename, w=width)} {width}w" for width in candidates]
+        urls.append(f"{url_for('images', filename=filename)} {size[0]}w")
+        return ', '.join(urls)
+
+    def responsive_image(self, filename, alt='', sizes='100vw', widths=None, **attrs):
+        """
+        <img> for `filename` with srcset, sizes and its intrinsic width and
+        height; attribute names ending in _ lose it, eg. class_
+        """
+        attrs = dict({'src': url_for('images', filename=filename), 'alt': alt}, **attrs)
+        srcset = self.srcset(filename, widths)
+        if srcset:
+            attrs.update(srcset=srcset, sizes=sizes)
+        size = self.dimensions(filename)
+        if size is not None:
+            attrs.setdefault('width', size[0])
+            attrs.setdefault('height', size[1])
+        return Markup('<img {}>').format(Markup(' ').join(
+            Markup('{}="{}"').format(name.rstrip('_').replace('_', '-'), value)
+            for name, value in attrs.items() if value is not None))
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'pending': len(self._futures),
+            'cache_bytes': self._usage,
+        }
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+import smtplib
+import threading
+
+from flask_mail import Connection
+
+from . import concurrency
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_transient(error):
+    """
+    whether delivering the message again can succeed: the connection failed
+    or the server answered 4xx, a 5xx reply rejects it for good
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+    elif isinstance(error, smtplib.SMTPResponseException):
+        codes = [error.smtp_code]
+    else:
+        # smtplib errors are OSErrors too, only the disconnects are about the connection
+        return isinstance(error, smtplib.SMTPServerDisconnected) or \
+            (isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException))
+    return bool(codes) and all(400 <= code < 500 for code in codes)
+
+
+class MailQueue(object):
+    """
+    in-process delivery queue drained by background workers, each keeping a
+    persistent SMTP connection
+    """
+
+    def __init__(self, mail=None, app=None):
+        self.mail = mail
+        self.app = None
+        self.enabled = False
+        self.workers = 1
+        self.batch_size = 1
+        self.max_retries = 0
+        self.retry_backoff = 1.0
+        self.idle_timeout = 30
+        self.maxsize = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        # messages neither sent nor given up on, queued or waiting to be retried
+        self._unfinished = 0
+        # token -> (message, attempt) of the retries waiting out their backoff
+        self._delayed = {}
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('MAIL_QUEUE_ENABLED', False)
+        self.workers = app.config.get('MAIL_QUEUE_WORKERS', 2)
+        self.batch_size = app.config.get('MAIL_QUEUE_BATCH_SIZE', 20)
+        self.max_retries = app.config.get('MAIL_QUEUE_MAX_RETRIES', 5)
+        self.retry_backoff = app.config.get('MAIL_QUEUE_RETRY_BACKOFF', 1.0)
+        self.idle_timeout = app.config.get('MAIL_QUEUE_IDLE_TIMEOUT', 30)
+        self.maxsize = app.config.get('MAIL_QUEUE_SIZE', 1000)
+
+        app.extensions['mail_queue'] = self
+
+    def send(self, message):
+        """
+        queue `message` for delivery and return at once, or send it inline
+        when the queue is disabled
+        """
+        if not self.enabled:
+            self.mail.send(message)
+            return
+
+        self._start()
+        with self._lock:
+            self._unfinished += 1
+        try:
+            self._queue.put_nowait((message, 0))
+        except concurrency.Full:
+            self._finished()
+            raise RuntimeError('Mail queue is full, try again later.')
+
+    def drain(self, timeout):
+        """
+        deliver the queued messages and the pending retries before the
+        process exits, for up to `timeout` seconds; return how many are
+        left undelivered
+        """
+        if self._pid != os.getpid():
+            return 0
+
+        # the process is going away, the retries get one more attempt now
+        with self._lock:
+            delayed, self._delayed = list(self._delayed.values()), {}
+        for item in delayed:
+            self._queue.put(item)
+
+        deadline = time.monotonic() + timeout
+        while self._unfinished and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if self._unfinished:
+            logger.error('Exiting with %d messages undelivered', self._unfinished)
+        return self._unfinished
+
+    def pending(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def stats(self):
+        return {
+            'pending': self.pending(),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+        }
+
+    def _start(self):
+        # workers belong to the process that spawned them, a forked worker
+        # starts its own on first use
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = concurrency.Queue(self.maxsize)
+            for _ in range(self.workers):
+                concurrency.spawn(self._work)
+            self._pid = os.getpid()
+
+    def _work(self):
+        connection = None
+        with self.app.app_context():
+            while True:
+                try:
+                    item = self._queue.get(timeout=self.idle_timeout)
+                except concurrency.Empty:
+                    connection = self._close(connection)
+                    continue
+
+                # drain what is already waiting into one batch
+                batch = [item]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except concurrency.Empty:
+                        break
+
+                for message, attempt in batch:
+                    try:
+                        if connection is None:
+                            connection = Connection(self.app.extensions['mail']).__enter__()
+                        connection.send(message)
+                        self.sent += 1
+                        self._finished()
+                    except Exception as e:
+                        if not is_transient(e):
+                            self.failed += 1
+                            self._finished()
+                            logger.exception('Dropping undeliverable message %r', message.subject)
+                            continue
+                        connection = self._close(connection)
+                        self._retry(message, attempt, e)
+
+    def _retry(self, message, attempt, error):
+        if attempt >= self.max_retries:
+            self.failed += 1
+            self._finished()
+            logger.error('Giving up on message %r after %d attempts: %s', message.subject, attempt + 1, error)
+            return
+
+        self.retried += 1
+        delay = self.retry_backoff * 2 ** attempt
+        logger.warning('Retrying message %r in %.1fs: %s', message.subject, delay, error)
+        token = object()
+        with self._lock:
+            self._delayed[token] = (message, attempt + 1)
+        concurrency.spawn_later(delay, self._resume, token)
+
+    def _resume(self, token):
+        # drain may have queued it already
+        with self._lock:
+            item = self._delayed.pop(token, None)
+        if item is not None:
+            self._queue.put(item)
+
+    def _finished(self):
+        with self._lock:
+            self._unfinished -= 1
+
+    def _close(self, connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except Exception:
+                pass
+        return None
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import glob
+import bisect
+import logging
+import threading
+
+from contextlib import nullcontext
+
+from flask import request, g, make_response
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+REQUESTS = 'site_requests_total'
+REQUEST_DURATION = 'site_request_duration_seconds'
+STAGE_DURATION = 'site_stage_duration_seconds'
+
+_null_stage = nullcontext()
+
+
+class Stage(object):
+    """
+    times the enclosed block into the stages of the current request
+    """
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stages = g.setdefault('metrics_stages', {})
+        stages[self.name] = stages.get(self.name, 0.0) + time.perf_counter() - self.start
+        return False
+
+
+class Registry(object):
+    """
+    counters and fixed bucket histograms keyed on (name, labels)
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # one count per bucket plus +Inf, then sum
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[bisect.bisect_left(self.buckets, value)] += 1
+            histogram[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'buckets': self.buckets,
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, labels, list(values)] for (name, labels), values in self.histograms.items()],
+            }
+
+    def merge(self, snapshot):
+        if tuple(snapshot['buckets']) != self.buckets:
+            # written with other buckets, it cannot be added up
+            return
+        with self._lock:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, values in snapshot['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    self.histograms[key] = list(values)
+                else:
+                    for i, value in enumerate(values):
+                        histogram[i] += value
+
+    def exposition(self):
+        """
+        the registry in the Prometheus text format
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{_labels(labels)} {value}')
+
+        for (name, labels), values in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(labels + (("le", str(bound)),))} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {values[-1]}')
+            lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels)
+    return '{' + pairs + '}'
+
+
+class Metrics(object):
+    """
+    per request and per stage timings, aggregated across pre-forked workers
+    through one snapshot file per process
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.server_timing = False
+        self.directory = None
+        self.flush_interval = 5
+        self.registry = Registry()
+        self._pid = None
+        self._flushed = 0
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('METRICS_ENABLED', False)
+        self.server_timing = app.config.get('METRICS_SERVER_TIMING', False)
+        self.directory = app.config.get('METRICS_DIRECTORY')
+        self.flush_interval = app.config.get('METRICS_FLUSH_INTERVAL', 5)
+        self.registry = Registry(app.config.get('METRICS_BUCKETS') or DEFAULT_BUCKETS)
+        self._pid = os.getpid()
+
+        if self.enabled:
+            if self.directory:
+                os.makedirs(self.directory, exist_ok=True)
+                self.prune()
+            # a plain rule, matched before the catch-all path converter
+            app.add_url_rule(app.config.get('METRICS_URL', '/metrics'), 'metrics', self.view)
+
+        app.extensions['metrics'] = self
+
+    def prune(self):
+        """
+        remove the snapshots of the processes gone, a cold start begins from
+        zero while the workers still serving through a reload keep theirs
+        """
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                os.kill(int(os.path.basename(path)[:-len('.json')]), 0)
+            except ValueError:
+                continue
+            except ProcessLookupError:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            except PermissionError:
+                # alive, run by another user
+                pass
+
+    @property
+    def active(self):
+        return self.enabled or self.server_timing
+
+    def stage(self, name):
+        """
+        context manager timing the `name` stage of the current request
+        """
+        if not self.active:
+            return _null_stage
+        return Stage(name)
+
+    def start(self):
+        if self.active:
+            g.metrics_start = time.perf_counter()
+
+    def inc(self, name, labels=(), value=1):
+        """
+        count into the registry from outside a request, eg. cache lookups
+        """
+        if self.enabled:
+            self._registry().inc(name, labels, value)
+
+    def set_path(self, name):
+        # Requests are labelled by template or file, a bounded set unlike raw urls
+        g.metrics_path = name
+
+    def finish(self, response):
+        start = g.get('metrics_start')
+        if start is None:
+            return response
+
+        duration = time.perf_counter() - start
+        stages = g.get('metrics_stages') or {}
+
+        if self.server_timing:
+            timings = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in stages.items()]
+            timings.append(f'total;dur={duration * 1000:.2f}')
+            response.headers['Server-Timing'] = ', '.join(timings)
+
+        if self.enabled and request.endpoint != 'metrics':
+            path = g.get('metrics_path')
+            if path is None:
+                path = request.url_rule.rule if request.url_rule else 'unmatched'
+            registry = self._registry()
+            registry.inc(REQUESTS, (('path', path), ('status', str(response.status_code))))
+            registry.observe(REQUEST_DURATION, (('path', path),), duration)
+            for name, seconds in stages.items():
+                registry.observe(STAGE_DURATION, (('stage', name),), seconds)
+
+            if time.monotonic() - self._flushed >= self.flush_interval:
+                self.flush()
+
+        return response
+
+    def flush(self):
+        """
+        write the snapshot of this process for the others to merge
+        """
+        self._flushed = time.monotonic()
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        tmp = f'{path}.tmp'
+        try:
+            with open(tmp, 'w') as file:
+                json.dump(self._registry().snapshot(), file)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning('Cannot write metrics snapshot %s: %s', path, e)
+
+    def collect(self):
+        """
+        registry summing the snapshots of every worker, this one up to date
+        """
+        self.flush()
+        if not self.directory:
+            return self._registry()
+
+        merged = Registry(self.registry.buckets)
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as file:
+                    merged.merge(json.load(file))
+            except (OSError, ValueError):
+                # replaced or half written by its worker right now, next scrape gets it
+                continue
+        return merged
+
+    def view(self):
+        response = make_response(self.collect().exposition())
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    def _registry(self):
+        # a forked worker starts from an empty registry, or from the snapshot
+        # of the dead process it took the pid of, so counters never go back
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    registry = Registry(self.registry.buckets)
+                    if self.directory:
+                        try:
+                            with open(os.path.join(self.directory, f'{os.getpid()}.json')) as file:
+                                registry.merge(json.load(file))
+                        except (OSError, ValueError):
+                            pass
+                    self.registry = registry
+                    self._pid = os.getpid()
+                    self._flushed = 0
+        return self.registry
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+
+from .lru import LRUCache
+
+
+# Extensions trusted without asking libmagic
+MIME_TYPES = {
+    '.html': 'text/html',
+    '.htm': 'text/html',
+    '.css': 'text/css',
+    '.js': 'text/javascript',
+    '.mjs': 'text/javascript',
+    '.json': 'application/json',
+    '.svg': 'image/svg+xml',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+    '.avif': 'image/avif',
+    '.ico': 'image/vnd.microsoft.icon',
+}
+
+
+class MimeDetector(object):
+    """
+    one libmagic handle per process, results cached on (path, mtime, size)
+    """
+
+    def __init__(self, app=None):
+        self.mime_types = dict(MIME_TYPES)
+        self.cache = LRUCache()
+        self._magic = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.cache = LRUCache(max_entries=app.config.get('MIME_CACHE_SIZE', 1024))
+        self.mime_types.update(app.config.get('MIME_TYPES') or {})
+
+        app.extensions['mime_detector'] = self
+
+    def from_file(self, path):
+        extension = os.path.splitext(path)[1].lower()
+        if extension in self.mime_types:
+            return self.mime_types[extension]
+
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        mime_type = self.cache.get(key)
+        if mime_type is None:
+            mime_type = self.sniff(path)
+            self.cache.set(key, mime_type)
+        return mime_type
+
+    def sniff(self, path):
+        # libmagic handles are not safe to share between threads
+        with self._lock:
+            if self._magic is None:
+                # imported on first use, most requests never get here
+                import magic
+                self._magic = magic.Magic(mime=True)
+            return self._magic.from_file(path)
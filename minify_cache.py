@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+from .lru import LRUCache
+
+
+class MinifyCache(object):
+    """
+    memoize htmlmin output on a blake2 digest of the unminified body
+    """
+
+    def __init__(self, app=None):
+        self.max_body_size = None
+        self.options = {}
+        self.cache = LRUCache()
+        self.bypasses = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_body_size = app.config.get('MINIFY_CACHE_MAX_BODY_SIZE')
+        self.options = {'remove_comments': app.config.get('MINIFY_REMOVE_COMMENTS', False)}
+        self.cache = LRUCache(
+            max_entries=app.config.get('MINIFY_CACHE_MAX_ENTRIES', 1024),
+            max_bytes=app.config.get('MINIFY_CACHE_MAX_BYTES'),
+        )
+
+        app.extensions['minify_cache'] = self
+
+    def minify(self, html):
+        from htmlmin.main import minify
+
+        if self.max_body_size is not None and len(html) > self.max_body_size:
+            self.bypasses += 1
+            return minify(html, **self.options)
+
+        key = hashlib.blake2b(html.encode('utf-8'), digest_size=16).digest()
+        minified = self.cache.get(key)
+        if minified is None:
+            minified = minify(html, **self.options)
+            self.cache.set(key, minified)
+        return minified
+
+    def stats(self):
+        return dict(self.cache.stats(), bypasses=self.bypasses)
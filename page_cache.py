@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+import io
+import time
+import hashlib
+import logging
+import threading
+
+from fnmatch import fnmatch
+
+from flask import request, g, make_response
+
+from .concurrency import Event, spawn_cooperative
+from .template_analysis import VOLATILE_NAMES
+from .template_context import check_ip_string, current_url
+
+
+# Request dependent template globals a page can be cached by, keyed by the
+# name a template reads
+VARY_CONTEXT = {
+    'check_ip_string': check_ip_string,
+    'current_url': current_url,
+}
+
+# Dropped from the environ a stale page is refreshed with, the refresh must render
+# the page instead of answering 304, reading a request body or sending a 103 to
+# the client of the original request
+REFRESH_DROP = ('werkzeug.request', 'HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE', 'CONTENT_LENGTH',
+                'wsgi.early_hints')
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(value):
+    if hasattr(value, 'items') and hasattr(value, 'getlist'):
+        return tuple(value.items(multi=True))
+    if hasattr(value, 'items'):
+        return tuple(sorted(value.items()))
+    return value
+
+
+class PageCache(object):
+    """
+    opt-in cache of rendered GET pages, stored in the Flask-Caching `cache`
+
+    One request per key renders a missing page while the others of this
+    process wait for it, an expired page is still served for `stale_grace`
+    seconds while a background request renders it again.
+    """
+
+    def __init__(self, cache=None, analyzer=None, assets=None, app=None):
+        self.app = None
+        self.cache = cache
+        self.analyzer = analyzer
+        self.assets = assets
+        self.enabled = False
+        self.default_timeout = None
+        self.timeouts = {}
+        self.stale_grace = 0
+        self.lock_timeout = None
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.stale = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        # cache key -> Event set once the request rendering it is done
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('PAGE_CACHE_ENABLED', False)
+        self.default_timeout = app.config.get('PAGE_CACHE_DEFAULT_TIMEOUT')
+        self.timeouts = app.config.get('PAGE_CACHE_TIMEOUTS') or {}
+        self.stale_grace = app.config.get('PAGE_CACHE_STALE_GRACE') or 0
+        self.lock_timeout = app.config.get('PAGE_CACHE_LOCK_TIMEOUT')
+
+        app.extensions['page_cache'] = self
+
+    def timeout_for(self, name):
+        for pattern, timeout in self.timeouts.items():
+            if fnmatch(name, pattern):
+                return timeout
+        return self.default_timeout
+
+    def key_for(self, name):
+        """
+        cache key of template `name` for the current request, None when the
+        page cannot be cached
+        """
+        # computed once per request, conditional_pages asks for it too
+        keys = g.setdefault('page_cache_keys', {})
+        if name not in keys:
+            keys[name] = self._key_for(name)
+        return keys[name]
+
+    def _key_for(self, name):
+        info = self.analyzer.analyse(name)
+        if info.dynamic or info.context_names & VOLATILE_NAMES:
+            return None
+
+        vary = [(attr, _normalize(getattr(request, attr, None))) for attr in sorted(info.request_attrs)]
+        vary += [(context_name, VARY_CONTEXT[context_name]())
+                 for context_name in sorted(info.context_names & VARY_CONTEXT.keys())]
+
+        digest = hashlib.blake2b(repr(vary).encode('utf-8'), digest_size=16)
+        for mtime in self.analyzer.signature(info):
+            digest.update(str(mtime).encode('ascii'))
+        if self.links_assets(info):
+            # the page embeds the content hash of the assets it links
+            digest.update(self.assets.version.encode('ascii'))
+        return f'page:{name}:{digest.hexdigest()}'
+
+    def links_assets(self, info):
+        return self.assets is not None and self.assets.version is not None and 'asset_url' in info.context_names
+
+    def last_modified(self, name):
+        """
+        newest mtime of template `name`, its includes and the assets it
+        links, in seconds
+        """
+        info = self.analyzer.analyse(name)
+        last_modified = self.analyzer.last_modified(info)
+        if self.links_assets(info) and self.assets.modified is not None:
+            last_modified = max(last_modified or 0, self.assets.modified / 1e9)
+        return last_modified
+
+    def get(self, name):
+        """
+        cached response for template `name`, or None after marking the
+        request so that response_page_cache stores what gets rendered
+        """
+        timeout = self.timeout_for(name)
+        if not self.enabled or request.method != 'GET' or not timeout:
+            self.bypasses += 1
+            return None
+
+        key = self.key_for(name)
+        if key is None:
+            self.bypasses += 1
+            return None
+
+        if g.get('page_cache_refresh'):
+            # the background request of revalidate, render and store
+            g.page_cache_key = key
+            g.page_cache_timeout = timeout
+            return None
+
+        entry = self.cache.get(key)
+        if entry is None:
+            event = self._acquire(key)
+            if event is None:
+                g.page_cache_leader = key
+            else:
+                # another request renders this page, use its result
+                self.coalesced += 1
+                event.wait(self.lock_timeout)
+                entry = self.cache.get(key)
+
+        if entry is None:
+            self.misses += 1
+            g.page_cache_key = key
+            g.page_cache_timeout = timeout
+            return None
+
+        body, content_type, fresh_until = entry
+        if fresh_until < time.time():
+            self.stale += 1
+            self.revalidate(key)
+        else:
+            self.hits += 1
+        response = make_response(body)
+        response.headers['Content-Type'] = content_type
+        g.page_cache_hit = True
+        return response
+
+    def store(self, response):
+        key = g.get('page_cache_key')
+        if key is None or response.status_code != 200 or response.is_streamed:
+            return response
+
+        timeout = g.page_cache_timeout
+        self.cache.set(key, (response.get_data(), response.headers['Content-Type'], time.time() + timeout),
+                       timeout=timeout + self.stale_grace)
+        return response
+
+    def revalidate(self, key):
+        """
+        render the page of the current request again in the background,
+        unless it is already being rendered
+        """
+        if self._acquire(key) is not None:
+            return
+
+        environ = {name: value for name, value in request.environ.items() if name not in REFRESH_DROP}
+        environ['wsgi.input'] = io.BytesIO()
+        self.refreshes += 1
+        spawn_cooperative(self._refresh, key, environ)
+
+    def _refresh(self, key, environ):
+        try:
+            with self.app.request_context(environ):
+                g.page_cache_refresh = True
+                self.app.full_dispatch_request()
+        except Exception:
+            logger.exception('Cannot refresh the cached page %s', key)
+        finally:
+            self.release(key)
+
+    def _acquire(self, key):
+        # None when the caller is the one rendering `key`, else the Event to wait on
+        with self._lock:
+            event = self._inflight.get(key)
+            if event is None:
+                self._inflight[key] = Event()
+            return event
+
+    def release(self, key=None):
+        """
+        wake the requests waiting for `key`, by default the page the current
+        request was rendering
+        """
+        if key is None:
+            key = g.pop('page_cache_leader', None)
+            if key is None:
+                return
+        with self._lock:
+            event = self._inflight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bypasses': self.bypasses,
+            'stale': self.stale,
+            'coalesced': self.coalesced,
+            'refreshes': self.refreshes,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import re
+import threading
+
+from collections import namedtuple
+from fnmatch import fnmatch
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+
+from flask import request, g
+
+
+Hint = namedtuple('Hint', ['url', 'asset', 'kind'])
+
+# href="{{ asset_url('css/site.css') }}", resolved per request since the hash changes
+ASSET_URL = re.compile(r'''^\{\{-?\s*asset_url\(\s*(['"])([^'"]+)\1\s*\)\s*-?\}\}$''')
+
+# Jinja tags opening and closing the blocks a page may not output
+CONDITIONAL_TAG = re.compile(r'\{%-?\s*(if|for|macro|call|endif|endfor|endmacro|endcall)\b.*?-?%\}', re.S)
+
+# Render blocking first, PRELOAD_HINTS_MAX keeps the head of the list
+PRIORITY = {'style': 0, 'font': 1, 'script': 2}
+
+
+class SubresourceParser(HTMLParser):
+    """
+    stylesheets, blocking scripts and declared preloads of a template
+    source, in document order
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.found = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        rel = (attrs.get('rel') or '').lower().split()
+        if tag == 'link' and 'stylesheet' in rel:
+            self.found.append((attrs.get('href'), 'style'))
+        elif tag == 'link' and 'preload' in rel and attrs.get('as'):
+            self.found.append((attrs.get('href'), attrs['as']))
+        elif tag == 'script' and attrs.get('src') and 'async' not in attrs \
+                and attrs.get('type') != 'module':
+            self.found.append((attrs['src'], 'script'))
+
+
+def unconditional(source):
+    """
+    `source` without the content of its if, for, macro and call blocks,
+    what every render of the template outputs
+    """
+    kept = []
+    depth = 0
+    position = 0
+    for match in CONDITIONAL_TAG.finditer(source):
+        if depth == 0:
+            kept.append(source[position:match.start()])
+        depth = max(0, depth + (-1 if match.group(1).startswith('end') else 1))
+        position = match.end()
+    if depth == 0:
+        kept.append(source[position:])
+    return ''.join(kept)
+
+
+def extract_hints(source):
+    """
+    hints for the same origin subresources of `source` the browser would
+    only find while parsing it, skipping URLs computed by other template
+    code and the ones only some renders output
+    """
+    parser = SubresourceParser()
+    parser.feed(unconditional(source))
+    parser.close()
+
+    hints = []
+    for url, kind in parser.found:
+        if not url:
+            continue
+        match = ASSET_URL.match(url.strip())
+        if match:
+            hints.append(Hint(None, match.group(2), kind))
+        elif '{{' not in url and '{%' not in url:
+            parts = urlsplit(url.strip())
+            # a third party fetch is not ours to start early
+            if not parts.scheme and not parts.netloc:
+                hints.append(Hint(url, None, kind))
+    return hints
+
+
+class PreloadHints(object):
+    """
+    rel=preload Link headers for the critical subresources of every
+    template, also sent as 103 Early Hints when the server offers
+    wsgi.early_hints
+    """
+
+    def __init__(self, analyzer=None, assets=None, app=None):
+        self.analyzer = analyzer
+        self.assets = assets
+        self.enabled = False
+        self.early_hints = False
+        self.max_hints = None
+        self.exclude = ()
+        # template name -> (analyzer signature, hints)
+        self.table = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('PRELOAD_HINTS_ENABLED', False)
+        self.early_hints = app.config.get('PRELOAD_EARLY_HINTS', False)
+        self.max_hints = app.config.get('PRELOAD_HINTS_MAX')
+        self.exclude = tuple(app.config.get('PRELOAD_HINTS_EXCLUDE') or ())
+
+        app.extensions['preload_hints'] = self
+
+    def hints(self, name):
+        """
+        hints of template `name` and of the templates it extends or
+        includes, extracted again once one of them changes
+        """
+        info = self.analyzer.analyse(name)
+        signature = self.analyzer.signature(info)
+        cached = self.table.get(name)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        hints = []
+        for filename in info.files.values():
+            try:
+                with open(filename, encoding='utf-8') as file:
+                    source = file.read()
+            except (OSError, UnicodeDecodeError):
+                continue
+            hints += [hint for hint in extract_hints(source) if hint not in hints]
+        hints = sorted(hints, key=lambda hint: PRIORITY.get(hint.kind, len(PRIORITY)))[:self.max_hints]
+        with self._lock:
+            self.table[name] = (signature, hints)
+        return hints
+
+    def warmup(self, names):
+        if not self.enabled:
+            return
+        for name in names:
+            if not any(fnmatch(name, pattern) for pattern in self.exclude):
+                self.hints(name)
+
+    def links(self, name):
+        if not self.enabled or any(fnmatch(name, pattern) for pattern in self.exclude):
+            return []
+
+        links = []
+        for hint in self.hints(name):
+            url = hint.url if hint.asset is None else self.assets.asset_url(hint.asset)
+            link = f'<{url}>; rel=preload; as={hint.kind}'
+            if hint.kind == 'font':
+                # fonts are always fetched in CORS mode, without it the preload is wasted
+                link += '; crossorigin'
+            links.append(link)
+        return links
+
+    def announce(self, name):
+        """
+        send the 103 for template `name` and remember its links for
+        finalize, call before any slow work on the page
+        """
+        links = self.links(name)
+        if not links:
+            return
+        g.preload_links = links
+
+        send = request.environ.get('wsgi.early_hints')
+        if self.early_hints and send is not None and request.method == 'GET':
+            send([('Link', ', '.join(links))])
+
+    def finalize(self, response):
+        links = g.get('preload_links')
+        if links and response.status_code == 200 and response.mimetype == 'text/html':
+            response.headers.add('Link', ', '.join(links))
+        return response
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+import threading
+
+from .lru import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+
+class RecaptchaVerifier(object):
+    """
+    siteverify client with a keep-alive pool, strict timeouts, a circuit
+    breaker and a short lived cache of the tokens already seen
+    """
+
+    def __init__(self, app=None):
+        self.url = None
+        self.secret = None
+        self.timeout = None
+        self.pool_size = 4
+        self.failure_threshold = 5
+        self.cooldown = 30
+        self.verdict_ttl = 120
+        self.verdicts = LRUCache()
+        self.failures = 0
+        self.opened_at = None
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.url = app.config.get('RECAPTCHA_VERIFY_URL')
+        self.secret = app.config.get('RECAPTCHA_V3_SECRET_KEY')
+        self.timeout = (
+            app.config.get('RECAPTCHA_CONNECT_TIMEOUT', 1.0),
+            app.config.get('RECAPTCHA_READ_TIMEOUT', 2.0),
+        )
+        self.pool_size = app.config.get('RECAPTCHA_POOL_SIZE', 4)
+        self.failure_threshold = app.config.get('RECAPTCHA_BREAKER_THRESHOLD', 5)
+        self.cooldown = app.config.get('RECAPTCHA_BREAKER_COOLDOWN', 30)
+        self.verdict_ttl = app.config.get('RECAPTCHA_VERDICT_TTL', 120)
+        self.verdicts = LRUCache(max_entries=app.config.get('RECAPTCHA_VERDICT_CACHE_SIZE', 10000))
+
+        app.extensions['recaptcha'] = self
+
+    @property
+    def session(self):
+        # sockets must not be shared with the processes forked after boot
+        if self._pid != os.getpid():
+            # requests is only imported by processes that verify a token
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._session = session
+            self._pid = os.getpid()
+        return self._session
+
+    def is_open(self):
+        if self.opened_at is None:
+            return False
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            # half open, let the next call probe the upstream
+            return False
+        return True
+
+    def verify(self, token, remote_ip=None):
+        """
+        True when Google accepts `token`, False for a rejected, reused or
+        unverifiable one
+        """
+        if not token:
+            return False
+
+        now = time.monotonic()
+        seen = self.verdicts.get(token)
+        if seen is not None and seen > now:
+            # tokens are single use, a second submission is a duplicate
+            return False
+
+        if self.is_open():
+            return False
+
+        import requests
+
+        try:
+            response = self.session.post(
+                self.url,
+                data={'secret': self.secret, 'response': token, 'remoteip': remote_ip},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            success = bool(response.json().get('success'))
+        except (requests.RequestException, ValueError) as e:
+            self._failure(e)
+            return False
+
+        self._success()
+        self.verdicts.set(token, now + self.verdict_ttl)
+        return success
+
+    def _failure(self, error):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning('reCAPTCHA verification failing, opening the circuit: %s', error)
+                self.opened_at = time.monotonic()
+
+    def _success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def stats(self):
+        return {
+            'open': self.is_open(),
+            'failures': self.failures,
+            'verdicts': len(self.verdicts),
+        }
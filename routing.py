@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import threading
+
+from collections import namedtuple
+
+
+Route = namedtuple('Route', ['path', 'kind', 'name'])
+
+TEMPLATE = 'template'
+STATIC = 'static'
+
+# Same precedence used by template_render_path when it probed the disk:
+# templates before static templates, exact name before .htm before .html
+SUFFIXES = ('', '.htm', '.html')
+
+
+class RouteIndex(object):
+    """
+    map every request path to the file template_render_path would serve,
+    built once and refreshed by scanning directory mtimes
+    """
+
+    def __init__(self, app=None):
+        self.roots = []
+        self.refresh_interval = None
+        self.routes = {}
+        self.generation = 0
+        self._dirs = {}
+        self._files = {}
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.roots = [
+            (TEMPLATE, app.config['TEMPLATES_PATH']),
+            (STATIC, app.config['STATIC_TEMPLATES_PATH']),
+        ]
+        self.refresh_interval = app.config.get('ROUTE_INDEX_REFRESH_INTERVAL')
+        self.rebuild()
+
+        app.extensions['route_index'] = self
+
+    def rebuild(self):
+        with self._lock:
+            self._dirs = {}
+            self._files = {}
+            for kind, root in self.roots:
+                self._scan(kind, root, root)
+            self._reindex()
+
+    def lookup(self, path):
+        self.refresh()
+        return self.routes.get(path)
+
+    def refresh(self, force=False):
+        if self.refresh_interval is None and not force:
+            return False
+
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.refresh_interval:
+            return False
+
+        with self._lock:
+            self._checked_at = now
+            changed = False
+            for directory, (kind, root, mtime) in list(self._dirs.items()):
+                try:
+                    current = os.stat(directory).st_mtime_ns
+                except OSError:
+                    current = None
+                if current != mtime:
+                    self._forget(directory)
+                    if current is not None:
+                        self._scan(kind, root, directory)
+                    changed = True
+
+            # a root created after startup has no recorded mtime yet
+            for kind, root in self.roots:
+                if root not in self._dirs and os.path.isdir(root):
+                    self._scan(kind, root, root)
+                    changed = True
+
+            if changed:
+                self._reindex()
+            return changed
+
+    def _scan(self, kind, root, directory):
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            entries = list(os.scandir(directory))
+        except OSError:
+            return
+
+        self._dirs[directory] = (kind, root, mtime)
+        files = []
+        for entry in entries:
+            if entry.is_dir():
+                if entry.path not in self._dirs:
+                    self._scan(kind, root, entry.path)
+            elif entry.is_file():
+                files.append(entry.path)
+        self._files[directory] = (kind, root, files)
+
+    def _forget(self, directory):
+        # drop the directory only, subdirectories keep their own mtimes
+        self._dirs.pop(directory, None)
+        self._files.pop(directory, None)
+
+    def _reindex(self):
+        ranked = {}
+        for rank_root, (kind, root) in enumerate(self.roots):
+            for directory, (file_kind, file_root, files) in self._files.items():
+                if file_root != root:
+                    continue
+                for filename in files:
+                    name = os.path.relpath(filename, root).replace(os.sep, '/')
+                    for rank_suffix, suffix in enumerate(SUFFIXES):
+                        if suffix and not name.endswith(suffix):
+                            continue
+                        key = name[:len(name) - len(suffix)] if suffix else name
+                        if not key:
+                            continue
+                        rank = rank_root * len(SUFFIXES) + rank_suffix
+                        if key not in ranked or rank < ranked[key][0]:
+                            ranked[key] = (rank, Route(filename, kind, name))
+
+        self.routes = {key: route for key, (rank, route) in ranked.items()}
+        self.generation += 1
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import io
+import errno
+import select
+import signal
+import socket
+import logging
+import subprocess
+
+import gevent
+
+from gevent.pywsgi import WSGIServer, WSGIHandler
+from gevent.socket import wait_write
+from werkzeug.http import parse_content_range_header
+from werkzeug.wsgi import FileWrapper
+
+
+logger = logging.getLogger(__name__)
+
+# Handed from a master to the one it re-executes on SIGHUP
+LISTENER_FD = 'PREFORK_LISTENER_FD'
+OLD_WORKERS = 'PREFORK_OLD_WORKERS'
+
+
+def bind_socket(host, port, backlog=1024, reuse_port=False):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class SendfileWrapper(FileWrapper):
+    """
+    wsgi.file_wrapper the SendfileHandler recognises, iterating it still
+    reads the file in blocks
+    """
+
+    def fileno(self):
+        try:
+            return self.file.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            return None
+
+
+def sendfile_source(wrapper, result, code, headers):
+    """
+    (file, offset, count) a WSGI result built on `wrapper` can be sent
+    with by os.sendfile, or None
+    """
+    if wrapper is None or wrapper.fileno() is None:
+        return None
+    if result is wrapper and code == 200:
+        return wrapper.file, 0, None
+    if code != 206:
+        return None
+
+    # a Range response iterates the wrapper it was given from the start of the range
+    value = next((value for name, value in headers if name.lower() == b'content-range'), b'')
+    content_range = parse_content_range_header(value.decode('latin-1'))
+    if content_range is None or content_range.units != 'bytes' or content_range.start is None:
+        return None
+    return wrapper.file, content_range.start, content_range.stop - content_range.start
+
+
+class SendfileHandler(WSGIHandler):
+    """
+    WSGIHandler offering wsgi.file_wrapper, files sent with send_file go from
+    the page cache to the socket with os.sendfile instead of through Python
+
+    It also offers wsgi.early_hints, a callable sending a 103 Early Hints
+    response with the given (name, value) headers ahead of the real one.
+    """
+
+    sendfile_block_size = 1024 * 1024
+
+    def get_environ(self):
+        environ = super().get_environ()
+        # encrypted bytes cannot skip userspace
+        self.file_wrapper = None
+        if not self.server.ssl_enabled:
+            environ['wsgi.file_wrapper'] = self.wrap_file
+        environ['wsgi.early_hints'] = self.early_hints
+        return environ
+
+    def wrap_file(self, file, block_size=8192):
+        # remembered, a Range response only hands back an iterable around it
+        self.file_wrapper = SendfileWrapper(file, block_size)
+        return self.file_wrapper
+
+    def early_hints(self, headers):
+        # HTTP/1.0 clients do not expect interim responses
+        if self.headers_sent or self.request_version != 'HTTP/1.1':
+            return False
+        lines = ['HTTP/1.1 103 Early Hints'] + [f'{name}: {value}' for name, value in headers]
+        try:
+            self.socket.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        except OSError:
+            # the real response runs into the same error and is logged then
+            return False
+        return True
+
+    def process_result(self):
+        source = sendfile_source(self.file_wrapper, self.result, self.code, self.response_headers)
+        if source is None or self.provided_content_length is None or self.command == 'HEAD':
+            return super().process_result()
+
+        file, offset, count = source
+        if count is None:
+            count = int(self.provided_content_length) - offset
+        elif count != int(self.provided_content_length):
+            return super().process_result()
+        # headers alone, a Content-Length was provided so nothing is chunked
+        self.write(b'')
+        self.response_length += self.sendfile(file.fileno(), offset, count)
+
+    def sendfile(self, in_fd, offset, count):
+        # gevent's socket.sendfile copies through send(), call os.sendfile and
+        # yield to the hub whenever the socket buffer is full
+        out_fd = self.socket.fileno()
+        sent = 0
+        while sent < count:
+            try:
+                n = os.sendfile(out_fd, in_fd, offset + sent, min(count - sent, self.sendfile_block_size))
+            except BlockingIOError:
+                wait_write(out_fd, timeout=self.socket.gettimeout())
+                continue
+            if n == 0:
+                # the file was truncated under us
+                break
+            sent += n
+        return sent
+
+
+class PreforkServer(object):
+    """
+    master process forking gevent WSGIServer workers on a shared listener,
+    or one SO_REUSEPORT listener per worker
+
+    SIGHUP replaces the workers one at a time, SIGTERM/SIGINT stop them
+    gracefully and dead workers are respawned. Workers are forks of the
+    master: with `command`, the argv starting the master, SIGHUP first runs
+    it with --check then re-executes the master in place so the new workers
+    load the code, config and manifests afresh; without it they only
+    recycle the processes. `shutdown` is called in each worker once it
+    stopped serving, with the seconds left of the graceful timeout.
+    """
+
+    def __init__(self, application, host='127.0.0.1', port=5000, workers=None,
+                 reuse_port=False, graceful_timeout=30, backlog=1024, server_class=WSGIServer,
+                 handler_class=SendfileHandler, command=None, shutdown=None):
+        self.application = application
+        self.command = command
+        self.shutdown = shutdown
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.reuse_port = reuse_port
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.server_class = server_class
+        self.handler_class = handler_class
+        self.listener = None
+        self.children = {}
+        self._reload = False
+        self._stopping = False
+
+    def run(self):
+        # set when the previous master re-executed into this one
+        inherited = os.environ.pop(LISTENER_FD, None)
+        old_workers = [int(pid) for pid in os.environ.pop(OLD_WORKERS, '').split(',') if pid]
+
+        if self.reuse_port:
+            # probe that the address is free, each worker binds its own socket
+            bind_socket(self.host, self.port, self.backlog, reuse_port=True).close()
+        elif inherited is not None:
+            self.listener = socket.socket(fileno=int(inherited))
+            self.listener.setblocking(False)
+        else:
+            self.listener = bind_socket(self.host, self.port, self.backlog)
+
+        signal.signal(signal.SIGHUP, self._on_hup)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        logger.info('Master %d serving on %s:%d with %d workers', os.getpid(), self.host, self.port, self.workers)
+        if old_workers:
+            # still children of this pid, replace them with workers running the new code
+            self.children = {pid: time.monotonic() for pid in old_workers}
+            self.rolling_restart()
+            for pid in list(self.children)[self.workers:]:
+                self.kill(pid, self.graceful_timeout)
+        while len(self.children) < self.workers:
+            self.spawn()
+
+        while not self._stopping:
+            self.reap()
+            if self._reload:
+                self._reload = False
+                self.reload()
+            while not self._stopping and len(self.children) < self.workers:
+                self.spawn()
+            time.sleep(0.5)
+
+        self.stop()
+
+    def spawn(self, wait=None):
+        """
+        fork a worker, with `wait` block up to that many seconds until it
+        accepts connections and return whether it did
+        """
+        ready_read, ready_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_read)
+            status = 0
+            try:
+                self.serve(ready_write)
+            except Exception:
+                logger.exception('Worker %d crashed', os.getpid())
+                status = 1
+            finally:
+                os._exit(status)
+
+        os.close(ready_write)
+        self.children[pid] = time.monotonic()
+        try:
+            if wait is None:
+                return pid, True
+            readable, _, _ = select.select([ready_read], [], [], wait)
+            return pid, bool(readable) and os.read(ready_read, 1) == b'1'
+        finally:
+            os.close(ready_read)
+
+    def serve(self, ready):
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        # reloads are driven by the master, a HUP sent to the whole group must not kill workers
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        gevent.reinit()
+
+        listener = self.listener
+        if listener is None:
+            listener = bind_socket(self.host, self.port, self.backlog, reuse_port=True)
+
+        server = self.server_class(listener, self.application, handler_class=self.handler_class)
+        server.start()
+
+        def stop():
+            # the master kills what is still running after the graceful timeout
+            deadline = time.monotonic() + self.graceful_timeout
+            server.stop(timeout=self.graceful_timeout)
+            if self.shutdown is not None:
+                self.shutdown(max(0, deadline - time.monotonic()))
+
+        gevent.signal_handler(signal.SIGTERM, stop)
+        gevent.signal_handler(signal.SIGINT, stop)
+
+        try:
+            os.write(ready, b'1')
+        except BrokenPipeError:
+            # the master did not wait for this one
+            pass
+        os.close(ready)
+        server.serve_forever()
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if self.children.pop(pid, None) is not None and not self._stopping:
+                logger.warning('Worker %d exited with status %d, respawning', pid, status)
+
+    def reload(self):
+        if self.command is None:
+            self.rolling_restart()
+            return
+
+        # a deploy that does not import keeps the current workers serving
+        try:
+            subprocess.run(self.command + ['--check'], check=True, timeout=self.graceful_timeout,
+                           stdin=subprocess.DEVNULL)
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.error('Not reloading, the new master does not start: %s', e)
+            return
+
+        env = dict(os.environ)
+        env[OLD_WORKERS] = ','.join(str(pid) for pid in self.children)
+        if self.listener is not None:
+            os.set_inheritable(self.listener.fileno(), True)
+            env[LISTENER_FD] = str(self.listener.fileno())
+        logger.info('Re-executing master %d to reload %d workers', os.getpid(), len(self.children))
+        for handler in logging.getLogger().handlers:
+            handler.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            os.execve(self.command[0], self.command, env)
+        except OSError:
+            logger.exception('Cannot re-execute the master, recycling the workers only')
+            self.rolling_restart()
+
+    def rolling_restart(self):
+        logger.info('Rolling restart of %d workers', len(self.children))
+        for old in list(self.children):
+            pid, ready = self.spawn(wait=self.graceful_timeout)
+            if not ready:
+                logger.error('Worker %d did not start, keeping worker %d', pid, old)
+                continue
+            self.kill(old, self.graceful_timeout)
+
+    def kill(self, pid, timeout):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                    break
+            except ChildProcessError:
+                break
+            time.sleep(0.05)
+        else:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.children.pop(pid, None)
+
+    def stop(self):
+        logger.info('Stopping %d workers', len(self.children))
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                self.children.pop(pid, None)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.children and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.05)
+        for pid in list(self.children):
+            os.kill(pid, signal.SIGKILL)
+        sys.exit(0)
+
+    def _on_hup(self, signum, frame):
+        self._reload = True
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
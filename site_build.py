@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+import os
+import gzip
+import json
+import hashlib
+
+from fnmatch import fnmatch
+
+import click
+
+from flask import render_template, request, current_app
+from flask.cli import with_appcontext
+
+from .routing import TEMPLATE
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+MANIFEST = 'manifest.json'
+
+# The app the pool workers inherit through fork
+_app = None
+
+
+def _render(name, output):
+    """
+    render, minify and precompress one template, runs in a pool worker
+    """
+    app = _app
+    minify_cache = app.extensions['minify_cache']
+
+    # The request dependent template globals still need a plausible request
+    with app.test_request_context(f'/{name}', environ_base={'REMOTE_ADDR': '127.0.0.1'}):
+        html = render_template(name, error_code=0, error_msg='')
+    if app.config.get('MINIFY_MODE') == 'response':
+        html = minify_cache.minify(html)
+
+    body = html.encode('utf-8')
+    target = os.path.join(output, name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    _write(target, body)
+
+    # Stale siblings would win over the new page, drop them before deciding
+    for suffix in ('.gz', '.br'):
+        if os.path.exists(target + suffix):
+            os.remove(target + suffix)
+    if len(body) >= app.config.get('COMPRESS_MIN_SIZE', 0):
+        _write(target + '.gz', gzip.compress(body, compresslevel=9, mtime=0))
+        if brotli is not None:
+            _write(target + '.br', brotli.compress(body, quality=11))
+
+    return name, hashlib.sha256(body).hexdigest(), len(body)
+
+
+def _write(path, data):
+    # Write then rename, so a running server never reads half a file
+    tmp = f'{path}.tmp{os.getpid()}'
+    with open(tmp, 'wb') as file:
+        file.write(data)
+    os.replace(tmp, path)
+
+
+class SiteBuild(object):
+    """
+    pre-rendered artifacts of the request independent templates
+    """
+
+    def __init__(self, analyzer=None, route_index=None, assets=None, app=None):
+        self.analyzer = analyzer
+        self.route_index = route_index
+        self.assets = assets
+        self.path = None
+        self.serve = False
+        self.exclude = ()
+        self.manifest = {}
+        self._manifest_mtime = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.path = app.config.get('BUILD_PATH')
+        self.serve = app.config.get('SITE_BUILD_SERVE', False)
+        self.exclude = app.config.get('SITE_BUILD_EXCLUDE') or ()
+        self.load()
+
+        app.cli.add_command(build_site_command)
+        app.extensions['site_build'] = self
+
+    def load(self):
+        manifest = os.path.join(self.path, MANIFEST)
+        try:
+            mtime = os.stat(manifest).st_mtime_ns
+            if mtime == self._manifest_mtime:
+                return
+            with open(manifest) as file:
+                self.manifest = json.load(file).get('templates', {})
+            self._manifest_mtime = mtime
+        except (OSError, ValueError):
+            self.manifest = {}
+            self._manifest_mtime = None
+
+    def candidates(self):
+        names = sorted({route.name for route in self.route_index.routes.values() if route.kind == TEMPLATE})
+        for name in names:
+            if not name.endswith(('.html', '.htm')):
+                continue
+            if any(fnmatch(name, pattern) for pattern in self.exclude):
+                continue
+            if self.analyzer.is_request_independent(self.analyzer.analyse(name)):
+                yield name
+
+    def assets_version(self, info):
+        # pages calling asset_url have the fingerprints of the build baked in
+        if self.assets is None or 'asset_url' not in info.context_names:
+            return None
+        return self.assets.version
+
+    def is_fresh(self, entry, info):
+        if entry.get('assets') != self.assets_version(info):
+            return False
+        for filename, mtime in entry['files'].items():
+            try:
+                if os.stat(filename).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def get(self, name):
+        """
+        path of the built artifact for template `name`, None when the page
+        has to be rendered live
+        """
+        if not self.serve or request.method not in ('GET', 'HEAD'):
+            return None
+
+        # picks up a build-site run made while the server is up
+        self.load()
+        entry = self.manifest.get(name)
+        if entry is None:
+            return None
+        info = self.analyzer.analyse(name)
+        if not self.is_fresh(entry, info):
+            return None
+        # a build made before the template read a request value
+        if not self.analyzer.is_request_independent(info):
+            return None
+        return os.path.join(self.path, entry['file'])
+
+    def build(self, app, jobs=None, force=False):
+        global _app
+
+        output = self.path
+        os.makedirs(output, exist_ok=True)
+        self.load()
+        previous = self.manifest
+
+        manifest = {}
+        pending = []
+        for name in self.candidates():
+            info = self.analyzer.analyse(name)
+            files = dict(zip(info.files.values(), self.analyzer.signature(info)))
+            entry = previous.get(name)
+            if not force and entry and entry['files'] == files \
+                    and entry.get('assets') == self.assets_version(info) \
+                    and os.path.isfile(os.path.join(output, entry['file'])):
+                manifest[name] = entry
+                continue
+            manifest[name] = {'file': name, 'files': files}
+            if self.assets_version(info) is not None:
+                manifest[name]['assets'] = self.assets_version(info)
+            pending.append(name)
+
+        _app = app
+        if pending:
+            # only the build command needs a process pool, serving processes skip the import
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            context = multiprocessing.get_context('fork') \
+                if 'fork' in multiprocessing.get_all_start_methods() else None
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as pool:
+                futures = [pool.submit(_render, name, output) for name in pending]
+                for future in futures:
+                    name, digest, size = future.result()
+                    manifest[name].update(sha256=digest, size=size)
+
+        _write(os.path.join(output, MANIFEST), json.dumps(
+            {'templates': manifest}, indent=2, sort_keys=True
+        ).encode('utf-8'))
+        self.load()
+        return pending, manifest
+
+
+@click.command('build-site')
+@click.option('--jobs', '-j', type=int, default=None, help='Worker processes, defaults to the CPU count.')
+@click.option('--force', is_flag=True, help='Rebuild every page, not only the changed ones.')
+@with_appcontext
+def build_site_command(jobs, force):
+    """Pre-render, minify and precompress the request independent templates."""
+    site_build = current_app.extensions['site_build']
+    built, manifest = site_build.build(current_app._get_current_object(), jobs=jobs, force=force)
+    for name in built:
+        click.echo(f'built {name}')
+    click.echo(f'{len(built)} built, {len(manifest) - len(built)} up to date in {site_build.path}')
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import zlib
+
+from flask import send_file
+
+from .lru import LRUCache
+
+
+class StaticFiles(object):
+    """
+    send_file keeping small files in memory, an entry is read again once the
+    mtime or size of its file changes; larger ones are left to the server's
+    file_wrapper
+    """
+
+    def __init__(self, app=None):
+        self.max_file_size = 0
+        self.cache = LRUCache()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_file_size = app.config.get('STATIC_CACHE_MAX_FILE_SIZE', 0)
+        self.cache = LRUCache(
+            max_entries=app.config.get('STATIC_CACHE_MAX_ENTRIES', 1024),
+            max_bytes=app.config.get('STATIC_CACHE_MAX_BYTES'),
+            sizeof=lambda entry: len(entry[1]),
+        )
+
+        app.extensions['static_files'] = self
+
+    def read(self, path, stat):
+        version = (stat.st_mtime_ns, stat.st_size)
+        entry = self.cache.get(path)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        with open(path, 'rb') as file:
+            data = file.read()
+        if len(data) == stat.st_size:
+            self.cache.set(path, (version, data))
+        else:
+            # replaced while reading, serve it but do not keep it
+            self.cache.pop(path)
+        return data
+
+    def send_file(self, path, mimetype=None, **kwargs):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        if stat.st_size > self.max_file_size:
+            return send_file(path, mimetype=mimetype, **kwargs)
+
+        kwargs.setdefault('download_name', os.path.basename(path))
+        kwargs.setdefault('last_modified', stat.st_mtime)
+        # the validator send_file computes for a path, a cached copy must not change it
+        kwargs.setdefault('etag', f'{stat.st_mtime}-{stat.st_size}-{zlib.adler32(path.encode()) & 0xFFFFFFFF}')
+        return send_file(io.BytesIO(self.read(path, stat)), mimetype=mimetype, **kwargs)
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+from fnmatch import fnmatch
+
+from flask import Response, stream_template
+
+from .template_minify import minify_chunks
+
+
+class StreamingPages(object):
+    """
+    render large templates as a stream, minified chunk by chunk, so the first
+    bytes leave before the rest of the page is rendered
+    """
+
+    def __init__(self, app=None):
+        self.templates = ()
+        self.min_size = None
+        self.buffer_size = 8192
+        self.minify = False
+        self.remove_comments = True
+        self.exclude = ()
+        # last rendered size of every template, in characters
+        self.sizes = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.templates = tuple(app.config.get('STREAM_TEMPLATES') or ())
+        self.min_size = app.config.get('STREAM_MIN_SIZE')
+        self.buffer_size = app.config.get('STREAM_BUFFER_SIZE', 8192)
+        self.minify = app.config.get('MINIFY_MODE') == 'response'
+        self.remove_comments = app.config.get('MINIFY_REMOVE_COMMENTS', True)
+        self.exclude = tuple(app.config.get('MINIFY_EXCLUDE') or ())
+
+        app.extensions['streaming_pages'] = self
+
+    def should_stream(self, name):
+        if any(fnmatch(name, pattern) for pattern in self.templates):
+            return True
+        size = self.sizes.get(name)
+        return self.min_size is not None and size is not None and size >= self.min_size
+
+    def record(self, name, size):
+        self.sizes[name] = size
+
+    def stream(self, name, mimetype, **context):
+        chunks = self._measure(name, stream_template(name, **context))
+        if self.minify and mimetype == 'text/html' \
+                and not any(fnmatch(name, pattern) for pattern in self.exclude):
+            chunks = minify_chunks(chunks, self.remove_comments, self.buffer_size)
+        else:
+            chunks = self._buffer(chunks)
+        return Response(chunks, mimetype=mimetype)
+
+    def _measure(self, name, chunks):
+        # the full size is only known once the last chunk is out
+        size = 0
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+        self.record(name, size)
+
+    def _buffer(self, chunks):
+        # Jinja yields a string per template node, send fewer larger writes
+        pending = []
+        size = 0
+        for chunk in chunks:
+            pending.append(chunk)
+            size += len(chunk)
+            if size >= self.buffer_size:
+                yield ''.join(pending)
+                pending = []
+                size = 0
+        if pending:
+            yield ''.join(pending)
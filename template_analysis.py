@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+
+from collections import namedtuple
+
+from jinja2 import meta, nodes
+
+from .template_context import REQUEST_CONTEXT
+
+
+TemplateInfo = namedtuple('TemplateInfo', [
+    'name',
+    'files',            # template name -> filename, the template and everything it pulls in
+    'request_attrs',    # attributes read from `request`, eg url, method, form
+    'context_names',    # names the template loads, context and globals alike
+    'dynamic',          # True when the template cannot be analysed statically
+])
+
+
+# Context names whose value changes with every render
+VOLATILE_NAMES = frozenset(['now', 'current_date', 'session', 'g'])
+
+# Context names computed from the request, eg. check_ip_string from the client address
+REQUEST_NAMES = frozenset(REQUEST_CONTEXT) | {'request'}
+
+
+class TemplateAnalyzer(object):
+    """
+    inspect the Jinja AST of a template and its includes, cached on mtime
+    """
+
+    def __init__(self, app=None):
+        self.env = None
+        self._cache = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.env = app.jinja_env
+
+        app.extensions['template_analyzer'] = self
+
+    def analyse(self, name):
+        cached = self._cache.get(name)
+        if cached is not None and cached[1] == self.signature(cached[0]):
+            return cached[0]
+
+        info = self._analyse(name)
+        with self._lock:
+            self._cache[name] = (info, self.signature(info))
+        return info
+
+    def signature(self, info):
+        # mtimes of every file the template depends on, None when one is gone
+        signature = []
+        for filename in info.files.values():
+            try:
+                signature.append(os.stat(filename).st_mtime_ns)
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def last_modified(self, info):
+        mtimes = [mtime for mtime in self.signature(info) if mtime is not None]
+        return max(mtimes) / 1e9 if mtimes else None
+
+    def is_request_independent(self, info):
+        return not (info.dynamic or info.request_attrs
+                    or info.context_names & REQUEST_NAMES
+                    or info.context_names & VOLATILE_NAMES)
+
+    def _analyse(self, name):
+        files = {}
+        request_attrs = set()
+        context_names = set()
+        dynamic = False
+
+        pending = [name]
+        while pending:
+            current = pending.pop()
+            if current in files:
+                continue
+
+            source, filename, _ = self.env.loader.get_source(self.env, current)
+            files[current] = filename
+            tree = self.env.parse(source, current, filename)
+
+            # meta.find_undeclared_variables hides environment globals such
+            # as request and session, so collect every loaded name instead
+            context_names |= {node.name for node in tree.find_all(nodes.Name) if node.ctx == 'load'}
+            request_attrs |= self._request_attrs(tree)
+            if self._bare_request(tree):
+                dynamic = True
+
+            for reference in meta.find_referenced_templates(tree):
+                if reference is None:
+                    dynamic = True
+                else:
+                    pending.append(reference)
+
+        return TemplateInfo(name, files, frozenset(request_attrs), frozenset(context_names), dynamic)
+
+    def _request_attrs(self, tree):
+        attrs = set()
+        for node in tree.find_all((nodes.Getattr, nodes.Getitem)):
+            if isinstance(node.node, nodes.Name) and node.node.name == 'request':
+                if isinstance(node, nodes.Getattr):
+                    attrs.add(node.attr)
+                elif isinstance(node.arg, nodes.Const):
+                    attrs.add(node.arg.value)
+        return attrs
+
+    def _bare_request(self, tree):
+        # `request` used other than as request.attr, eg passed to a macro
+        wrapped = set()
+        for node in tree.find_all((nodes.Getattr, nodes.Getitem)):
+            if isinstance(node.node, nodes.Name) and node.node.name == 'request':
+                if isinstance(node, nodes.Getattr) or isinstance(node.arg, nodes.Const):
+                    wrapped.add(id(node.node))
+        return any(
+            node.name == 'request' and id(node) not in wrapped
+            for node in tree.find_all(nodes.Name)
+        )
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Values every template can read, as Jinja globals.
+
+The constants are computed once per app, the request dependent values are
+proxies evaluated the first time a template of the request reads them.
+"""
+
+import datetime
+import ipaddress
+
+from flask import request, g, url_for
+from werkzeug.local import LocalProxy
+
+
+def ip_check_digits(remote_addr):
+    """
+    leading decimal digit of every octet (IPv4) or group (IPv6) of
+    `remote_addr`, the robot check of the contact form sums them
+    """
+    try:
+        address = ipaddress.ip_address(remote_addr)
+    except ValueError:
+        return []
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    if address.version == 4:
+        parts = (int(octet) for octet in str(address).split('.'))
+    else:
+        parts = (int(group, 16) for group in address.exploded.split(':'))
+    return [int(str(part)[0]) for part in parts]
+
+
+def check_ip_string():
+    return [str(digit) for digit in ip_check_digits(request.remote_addr)]
+
+
+def current_url():
+    return request.url_rule.endpoint if request.url_rule else ''
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def current_date():
+    return datetime.datetime.now()
+
+
+# Keyed by the name templates read them as
+REQUEST_CONTEXT = {
+    'now': now,
+    'current_date': current_date,
+    'current_url': current_url,
+    'check_ip_string': check_ip_string,
+}
+
+
+def lazy(name, func):
+    """
+    proxy to func(), called at most once per request
+    """
+    def resolve():
+        values = g.setdefault('template_context', {})
+        if name not in values:
+            values[name] = func()
+        return values[name]
+    return LocalProxy(resolve)
+
+
+def request_context():
+    return {name: lazy(name, func) for name, func in REQUEST_CONTEXT.items()}
+
+
+def static_context(config):
+    return {
+        'config': config,
+        'application_env': config.APPLICATION_ENV,
+        'get_url': url_for,
+        'ADMIN_URL_PREFIX': config.ADMIN_URL_PREFIX,
+        'BASE_URL': config.BASE_URL,
+        'STATIC_URL': config.STATIC_URL,
+        'URLS': config.URLS,
+        'TIMEZONE': config.TIMEZONE,
+        'DATE_TIME_FORMAT': config.DATE_TIME_FORMAT,
+        'DATE_FORMAT': config.DATE_FORMAT,
+        'APPLICATION_PATH': config.APPLICATION_PATH,
+        'INSTANCE_FOLDER_PATH': config.INSTANCE_FOLDER_PATH,
+        'BASE_PATH': config.BASE_PATH,
+        'STATIC_PATH': config.STATIC_PATH,
+        'STATIC_IMAGES_PATH': config.STATIC_IMAGES_PATH,
+        'PATHS': config.PATHS,
+    }
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+from fnmatch import fnmatch
+
+from jinja2.ext import Extension
+from jinja2.lexer import Token
+
+
+TAG_NAME = re.compile(r'</?([a-zA-Z][a-zA-Z0-9-]*)')
+UNQUOTED_VALUE = re.compile(r'[^\s"\'=<>`]+')
+
+# Same defaults as htmlmin
+PRE_TAGS = ('pre', 'textarea')
+
+# Raw text elements, their content is script or css and htmlmin leaves it alone too
+RAW_TAGS = PRE_TAGS + ('script', 'style')
+
+# Jinja tags that never output anything themselves, the whitespace around them
+# can be collapsed as if the two chunks of text were one
+SILENT_TAGS = frozenset(['if', 'elif', 'else', 'endif', 'for', 'endfor', 'set', 'endset', 'do'])
+
+TEXT, TAG, QUOTE, COMMENT, PRE = range(5)
+
+
+class HTMLMinifyState(object):
+    """
+    incremental htmlmin-like minifier for the static text of a template,
+    the state survives the Jinja tags between two chunks of text
+    """
+
+    def __init__(self, remove_comments=True):
+        self.remove_comments = remove_comments
+        self.state = TEXT
+        self.quote = None
+        self.pre_tag = None
+        self.tag_opens_pre = False
+        self.ends_with_space = False
+        # htmlmin drops whitespace only text in these, and trims the title
+        self.in_head = False
+        self.in_title = False
+        self.after_doctype = False
+        self.last_char = ''
+
+    def feed(self, data, after_space=False):
+        if after_space and self.state in (TEXT, TAG):
+            data = data.lstrip()
+
+        out = []
+        i = 0
+        length = len(data)
+        while i < length:
+            char = data[i]
+
+            if self.state in (TEXT, TAG) and char.isspace():
+                j = i
+                while j < length and data[j].isspace():
+                    j += 1
+                if self.state == TEXT and self._drops_space(out[-1][-1] if out else self.last_char,
+                                                            data[j] if j < length else ''):
+                    i = j
+                    continue
+                # a dropped comment leaves the whitespace around it adjacent
+                if not (out[-1] == ' ' if out else after_space):
+                    out.append(' ')
+                i = j
+                continue
+
+            if self.state == TEXT:
+                if char == '<':
+                    if data.startswith('<!--', i) and self.remove_comments and not data.startswith('<!--!', i):
+                        self.state = COMMENT
+                        i += 4
+                        continue
+                    if data[i + 2:i + 9].lower() == 'doctype' and data.startswith('<!', i):
+                        self.after_doctype = True
+                    match = TAG_NAME.match(data, i)
+                    if match:
+                        name = match.group(1).lower()
+                        self._enter(name, match.group(0).startswith('</'))
+                        self.tag_opens_pre = name in RAW_TAGS and not match.group(0).startswith('</')
+                        if self.tag_opens_pre:
+                            self.pre_tag = name
+                        self.state = TAG
+                out.append(char)
+
+            elif self.state == TAG:
+                if char in '"\'':
+                    end = data.find(char, i + 1)
+                    if end == -1:
+                        # the value goes on past a Jinja tag, keep it quoted
+                        self.quote = char
+                        self.state = QUOTE
+                        out.append(data[i:])
+                        break
+                    value = data[i + 1:end]
+                    if out and out[-1].endswith('=') and not value:
+                        out[-1] = out[-1][:-1]
+                    elif out and out[-1].endswith('=') and UNQUOTED_VALUE.fullmatch(value):
+                        out.append(value)
+                    else:
+                        out.append(data[i:end + 1])
+                    i = end + 1
+                    continue
+                if char == '/' and data.startswith('/>', i):
+                    # htmlmin drops the self-closing slash
+                    i += 1
+                    continue
+                if char == '>':
+                    if out and out[-1] == ' ':
+                        out.pop()
+                    self.state = PRE if self.tag_opens_pre else TEXT
+                out.append(char)
+
+            elif self.state == QUOTE:
+                end = data.find(self.quote, i)
+                if end == -1:
+                    out.append(data[i:])
+                    break
+                out.append(data[i:end + 1])
+                self.state = TAG
+                i = end + 1
+                continue
+
+            elif self.state == COMMENT:
+                end = data.find('-->', i)
+                if end == -1:
+                    break
+                self.state = TEXT
+                i = end + 3
+                continue
+
+            elif self.state == PRE:
+                end = data.lower().find(f'</{self.pre_tag}', i)
+                if end == -1:
+                    out.append(data[i:])
+                    break
+                out.append(data[i:end])
+                self.state = TEXT
+                self.tag_opens_pre = False
+                i = end
+                continue
+
+            i += 1
+
+        result = ''.join(out)
+        if result:
+            self.last_char = result[-1]
+            self.ends_with_space = result[-1] == ' ' and self.state in (TEXT, TAG, COMMENT)
+        return result
+
+    def _enter(self, name, closing):
+        if closing:
+            if name == 'head':
+                self.in_head = False
+            elif name == 'title':
+                self.in_title = False
+            return
+        self.after_doctype = False
+        if name == 'head':
+            self.in_head = True
+        elif name == 'title' and self.in_head:
+            self.in_title = True
+
+    def _drops_space(self, before, after):
+        # whitespace between `before` and `after`, '' when not known yet
+        if self.in_title:
+            return before == '>' or after == '<'
+        return (self.in_head or self.after_doctype) and before == '>' and after == '<'
+
+
+def minify_chunks(chunks, remove_comments=True, buffer_size=8192):
+    """
+    minify an html document arriving in chunks, yielding about `buffer_size`
+    characters at a time, cut right after a `>` so no tag, comment end or
+    closing pre tag is split between two feeds
+    """
+    state = HTMLMinifyState(remove_comments)
+    pending = []
+    size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        size += len(chunk)
+        if size < buffer_size:
+            continue
+        data = ''.join(pending)
+        cut = data.rfind('>') + 1
+        if not cut:
+            pending, size = [data], len(data)
+            continue
+        rest = data[cut:]
+        pending, size = [rest], len(rest)
+        minified = state.feed(data[:cut], after_space=state.ends_with_space)
+        if minified:
+            yield minified
+
+    minified = state.feed(''.join(pending), after_space=state.ends_with_space)
+    if minified:
+        yield minified
+
+
+class MinifyExtension(Extension):
+    """
+    minify the static text of html templates once, when they are compiled
+    """
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(
+            minify_remove_comments=True,
+            minify_exclude=(),
+        )
+
+    def filter_stream(self, stream):
+        name = stream.name or ''
+        if not name.endswith(('.html', '.htm')) or any(
+            fnmatch(name, pattern) for pattern in self.environment.minify_exclude
+        ):
+            yield from stream
+            return
+
+        state = HTMLMinifyState(self.environment.minify_remove_comments)
+        # True while only silent tags followed the last chunk of text
+        silent = False
+        previous = None
+        for token in stream:
+            if token.type == 'data':
+                value = state.feed(token.value, after_space=silent and state.ends_with_space)
+                token = Token(token.lineno, token.type, value)
+                silent = True
+            elif token.type == 'variable_begin':
+                silent = False
+            elif token.type == 'name' and previous == 'block_begin' and token.value not in SILENT_TAGS:
+                silent = False
+            previous = token.type
+            yield token
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import hashlib
+import logging
+
+from jinja2 import FileSystemBytecodeCache
+from jinja2.bccache import Bucket
+from flask import make_response
+
+
+logger = logging.getLogger(__name__)
+
+
+def environment_fingerprint(environment):
+    """
+    digest of the environment settings that change the compiled code of a
+    template, eg. the compile time minifier
+    """
+    settings = (
+        sorted(environment.extensions),
+        environment.trim_blocks,
+        environment.lstrip_blocks,
+        environment.newline_sequence,
+        getattr(environment, 'minify_remove_comments', None),
+        tuple(getattr(environment, 'minify_exclude', ())),
+    )
+    return hashlib.blake2b(repr(settings).encode('utf-8'), digest_size=8).hexdigest()
+
+
+class EnvironmentBytecodeCache(FileSystemBytecodeCache):
+    """
+    FileSystemBytecodeCache keyed on the environment fingerprint too, the
+    same source is compiled differently with another MINIFY_MODE
+    """
+
+    def get_bucket(self, environment, name, filename, source):
+        key = self.get_cache_key(f'{name}:{environment_fingerprint(environment)}', filename)
+        bucket = Bucket(environment, key, self.get_source_checksum(source))
+        self.load_bytecode(bucket)
+        return bucket
+
+
+class TemplateWarmup(object):
+    """
+    on-disk bytecode cache shared by the workers and a boot time compile of
+    every template, done before the server forks and accepts connections
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.compiled = 0
+        self.failed = 0
+        self.duration = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('TEMPLATE_WARMUP', False)
+
+        cache_path = app.config.get('TEMPLATE_BYTECODE_CACHE_PATH')
+        if cache_path:
+            os.makedirs(cache_path, exist_ok=True)
+            app.jinja_env.bytecode_cache = EnvironmentBytecodeCache(cache_path)
+
+        url = app.config.get('READINESS_URL')
+        if url:
+            app.add_url_rule(url, 'readiness', self.view)
+
+        app.extensions['template_warmup'] = self
+
+    def warmup(self):
+        """
+        load every template, from the bytecode cache when the source did not
+        change, before the process takes traffic
+        """
+        if self.enabled:
+            environment = self.app.jinja_env
+            start = time.perf_counter()
+            for name in environment.list_templates():
+                try:
+                    environment.get_template(name)
+                    self.compiled += 1
+                except Exception:
+                    # the request for it will fail the same way, do not keep the site down
+                    self.failed += 1
+                    logger.exception('Cannot compile template %s', name)
+            self.duration = time.perf_counter() - start
+            logger.info('Warmed up %d templates in %.1fms', self.compiled, self.duration * 1000)
+
+    def view(self):
+        # answering at all means the app, warmup included, is loaded
+        response = make_response('ready')
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    def stats(self):
+        return {
+            'compiled': self.compiled,
+            'failed': self.failed,
+            'duration': self.duration,
+        }
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from .. import constants, init_app
+from ..config import config as env_config
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    # the files the app writes next to the package go to a scratch directory
+    instance = tmp_path_factory.mktemp('instance')
+    for name, value in constants.PATHS.items():
+        if isinstance(value, str) and value.startswith(constants.INSTANCE_FOLDER_PATH + os.sep) \
+                and not value.startswith(constants.BASE_PATH):
+            setattr(env_config, name, os.path.join(instance, os.path.relpath(value, constants.INSTANCE_FOLDER_PATH)))
+    env_config.INSTANCE_FOLDER_PATH = str(instance)
+
+    app = init_app()
+    app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Local SMTP server for the mail queue tests and benchmarks.
+"""
+
+import time
+import threading
+import socketserver
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """
+    local SMTP stand-in that discards every message, answering the end of
+    DATA with `replies` in turn and then with 250
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, replies=()):
+        super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+        self.latency = latency
+        self.replies = list(replies)
+        self.received = 0
+        self.rejected = 0
+        self.connections = 0
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.connections += 1
+        # stands in for the TCP+TLS handshake of a real server
+        time.sleep(self.server.latency)
+        self.reply('220 sink ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                self.reply('250 sink')
+            elif command == b'DATA':
+                self.reply('354 go ahead')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                reply = self.server.replies.pop(0) if self.server.replies else '250 queued'
+                if reply.startswith('250'):
+                    self.server.received += 1
+                else:
+                    self.server.rejected += 1
+                self.reply(reply)
+            elif command == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+    def reply(self, text):
+        self.wfile.write(text.encode('ascii') + b'\r\n')
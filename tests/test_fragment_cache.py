@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+import pytest
+
+from flask import render_template_string
+
+from ..extensions import cache, fragment_cache
+from ..fragment_cache import FragmentCache
+
+
+TEMPLATE = '{% cache "nav:main" %}{{ counter() }}{% endcache %}'
+
+
+@pytest.fixture
+def render(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(fragment_cache, 'enabled', True)
+    monkeypatch.setattr(fragment_cache, 'generations_log', str(tmp_path / 'generations.log'))
+    calls = []
+
+    def counter():
+        calls.append(1)
+        return len(calls)
+
+    def render():
+        with app.test_request_context('/'):
+            return render_template_string(TEMPLATE, counter=counter)
+
+    with app.app_context():
+        cache.clear()
+    yield render
+    with app.app_context():
+        cache.clear()
+
+
+def test_invalidate_renders_again(app, render):
+    assert render() == render() == '1'
+    with app.app_context():
+        fragment_cache.invalidate('other')
+    assert render() == '1'
+    with app.app_context():
+        fragment_cache.invalidate('nav')
+    assert render() == '2'
+
+
+def test_invalidation_reaches_other_workers(app, render):
+    assert render() == '1'
+    # a worker with its own state, reading the same log
+    worker = FragmentCache(cache, fragment_cache.analyzer, fragment_cache.assets)
+    worker.generations_log = fragment_cache.generations_log
+    with app.app_context():
+        worker.invalidate('nav')
+    assert render() == '2'
+
+
+def test_concurrent_invalidations_all_count(render):
+    before = fragment_cache.generations()['nav']
+    threads = [threading.Thread(target=fragment_cache.invalidate, args=('nav',)) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert fragment_cache.generations()['nav'] == before + 20
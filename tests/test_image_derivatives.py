@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from ..extensions import image_derivatives
+
+
+@pytest.mark.parametrize('requested, quality', [
+    (None, 80),
+    (1, 50),
+    (50, 50),
+    (51, 65),
+    (79, 80),
+    (85, 90),
+    (100, 90),
+])
+def test_quality_snaps_to_configured(app, requested, quality):
+    assert image_derivatives.quality_for(requested) == quality
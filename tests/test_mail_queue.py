@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import time
+import smtplib
+
+import pytest
+
+from flask_mail import Message
+
+from .smtp import SMTPSink
+from ..extensions import mail
+from ..mail_queue import MailQueue, is_transient
+
+
+MAX_RETRIES = 2
+
+RETRY_BACKOFF = 0.05
+
+
+def message(subject='test'):
+    return Message(subject, sender='test@localhost', recipients=['sink@localhost'], body='x' * 64)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def sink():
+    sink = SMTPSink().start()
+    yield sink
+    sink.shutdown()
+    sink.server_close()
+
+
+@pytest.fixture
+def queue(app, sink):
+    saved = app.extensions['mail']
+    app.extensions['mail'] = mail.init_mail({'MAIL_SERVER': '127.0.0.1', 'MAIL_PORT': sink.server_address[1]})
+
+    # not init_app, the app keeps its own queue
+    queue = MailQueue(mail)
+    queue.app = app
+    queue.enabled = True
+    queue.max_retries = MAX_RETRIES
+    queue.retry_backoff = RETRY_BACKOFF
+    try:
+        yield queue
+    finally:
+        app.extensions['mail'] = saved
+
+
+def test_reuses_connection(queue, sink):
+    for _ in range(10):
+        queue.send(message())
+
+    wait_for(lambda: queue.sent == 10)
+    assert sink.received == 10
+    assert sink.connections == 1
+
+
+def test_retries_temporary_rejection(queue, sink):
+    sink.replies = ['451 try again later', '452 out of storage']
+    start = time.monotonic()
+    queue.send(message())
+
+    wait_for(lambda: queue.sent == 1)
+    # backoff doubles between attempts
+    assert time.monotonic() - start >= RETRY_BACKOFF * (1 + 2)
+    assert queue.retried == 2
+    assert queue.failed == 0
+    assert (sink.rejected, sink.received) == (2, 1)
+    # dropped after each failure
+    assert sink.connections == 3
+
+
+def test_gives_up_after_max_retries(queue, sink):
+    sink.replies = ['451 try again later'] * (MAX_RETRIES + 1)
+    queue.send(message())
+
+    wait_for(lambda: queue.failed == 1)
+    assert queue.retried == MAX_RETRIES
+    assert sink.rejected == MAX_RETRIES + 1
+
+    queue.send(message())
+    wait_for(lambda: queue.sent == 1)
+    assert sink.received == 1
+
+
+def test_permanent_rejection_not_retried(queue, sink):
+    sink.replies = ['554 message rejected']
+    queue.send(message('rejected'))
+    queue.send(message('accepted'))
+
+    wait_for(lambda: queue.sent == 1)
+    assert queue.failed == 1
+    assert queue.retried == 0
+    assert (sink.rejected, sink.received) == (1, 1)
+    assert sink.connections == 1
+
+
+def test_drain_delivers_pending_retries(queue, sink):
+    queue.retry_backoff = 60
+    sink.replies = ['451 try again later']
+    queue.send(message())
+    wait_for(lambda: queue.retried == 1)
+
+    start = time.monotonic()
+    assert queue.drain(5) == 0
+    assert time.monotonic() - start < 5
+    assert queue.sent == sink.received == 1
+
+
+def test_drain_reports_undelivered(queue, sink, caplog):
+    queue.retry_backoff = 60
+    sink.replies = ['451 try again later'] * (MAX_RETRIES + 1)
+    queue.send(message())
+    wait_for(lambda: queue.retried == 1)
+
+    assert queue.drain(0.2) == 1
+    assert 'Exiting with 1 messages undelivered' in caplog.text
+
+
+@pytest.mark.parametrize('error, transient', [
+    (smtplib.SMTPServerDisconnected(), True),
+    (ConnectionRefusedError(), True),
+    (smtplib.SMTPConnectError(421, b'busy'), True),
+    (smtplib.SMTPConnectError(554, b'no service'), False),
+    (smtplib.SMTPDataError(451, b'later'), True),
+    (smtplib.SMTPDataError(554, b'rejected'), False),
+    (smtplib.SMTPSenderRefused(550, b'unknown', 'test@localhost'), False),
+    (smtplib.SMTPRecipientsRefused({'a@localhost': (450, b'busy')}), True),
+    (smtplib.SMTPRecipientsRefused({'a@localhost': (450, b'busy'), 'b@localhost': (550, b'unknown')}), False),
+    (smtplib.SMTPNotSupportedError(), False),
+])
+def test_is_transient(error, transient):
+    assert is_transient(error) is transient
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+
+from ..metrics import Metrics
+
+
+def test_prune_keeps_live_workers(tmp_path):
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    gone = process.pid
+    for pid in (os.getpid(), gone):
+        (tmp_path / f'{pid}.json').write_text('{}')
+
+    metrics = Metrics()
+    metrics.directory = str(tmp_path)
+    metrics.prune()
+    assert sorted(os.listdir(tmp_path)) == [f'{os.getpid()}.json']
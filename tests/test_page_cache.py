@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+import gevent
+import pytest
+
+from flask import template_rendered
+
+from ..extensions import cache, page_cache, preload_hints, streaming_pages
+
+
+CONCURRENCY = 16
+
+# Long enough for every request of a burst to arrive while the first renders
+RENDER_DELAY = 0.1
+
+
+def in_threads(app, count):
+    barrier = threading.Barrier(count)
+    statuses = []
+
+    def client():
+        with app.test_client() as client:
+            barrier.wait()
+            statuses.append(client.get('/').status_code)
+
+    threads = [threading.Thread(target=client) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return statuses
+
+
+def in_greenlets(app, count):
+    # the way gevent's WSGIServer runs requests, on an unpatched hub
+    def client():
+        with app.test_client() as client:
+            return client.get('/').status_code
+
+    greenlets = [gevent.spawn(client) for _ in range(count)]
+    gevent.joinall(greenlets, raise_error=True)
+    return [greenlet.value for greenlet in greenlets]
+
+
+@pytest.fixture(params=[in_threads, in_greenlets], ids=['threads', 'greenlets'])
+def herd(request, app):
+    run = request.param
+    renders = []
+
+    def rendered(sender, template, context, **extra):
+        renders.append(template.name)
+        if run is in_greenlets:
+            gevent.sleep(RENDER_DELAY)
+        else:
+            time.sleep(RENDER_DELAY)
+
+    saved = page_cache.enabled, page_cache.default_timeout, page_cache.timeouts, page_cache.stale_grace
+    page_cache.enabled, page_cache.default_timeout, page_cache.timeouts, page_cache.stale_grace = True, 60, {}, 60
+    template_rendered.connect(rendered, app)
+    with app.app_context():
+        cache.clear()
+    try:
+        yield lambda: run(app, CONCURRENCY), renders
+    finally:
+        template_rendered.disconnect(rendered, app)
+        page_cache.enabled, page_cache.default_timeout, page_cache.timeouts, page_cache.stale_grace = saved
+        with app.app_context():
+            cache.clear()
+
+
+def expire(app):
+    """
+    put the cached index page past its freshness, still in the grace
+    window, and return its key
+    """
+    with app.test_client() as client:
+        # the key varies with the client, eg. check_ip_string
+        client.get('/')
+        key = page_cache.key_for('index.html')
+    with app.app_context():
+        body, content_type, _ = cache.get(key)
+        cache.set(key, (body, content_type, time.time() - 1))
+    return key
+
+
+def wait_refreshed(timeout=5):
+    deadline = time.monotonic() + timeout
+    while page_cache._inflight and time.monotonic() < deadline:
+        gevent.sleep(0.01)
+    assert not page_cache._inflight
+
+
+def test_missing_page_renders_once(herd):
+    burst, renders = herd
+    assert burst() == [200] * CONCURRENCY
+    assert renders == ['index.html']
+
+
+def test_streamed_page_renders_once(app, herd, monkeypatch):
+    monkeypatch.setattr(streaming_pages, 'templates', ('index.html',))
+    burst, renders = herd
+    assert burst() == [200] * CONCURRENCY
+    assert renders == ['index.html']
+
+    # stored, the next request is a hit
+    assert app.test_client().get('/').status_code == 200
+    assert renders == ['index.html']
+
+
+def test_expired_page_renders_once(app, herd):
+    burst, renders = herd
+    burst()
+    del renders[:]
+
+    key = expire(app)
+    assert burst() == [200] * CONCURRENCY
+    wait_refreshed()
+    assert renders == ['index.html']
+    with app.app_context():
+        assert cache.get(key)[2] > time.time()
+
+
+def test_refresh_sends_no_early_hints(app, herd, monkeypatch):
+    monkeypatch.setattr(preload_hints, 'links', lambda name: ['</site.css>; rel=preload; as=style'])
+    burst, renders = herd
+    burst()
+    del renders[:]
+    expire(app)
+
+    sent = []
+    response = app.test_client().get('/', environ_base={'wsgi.early_hints': sent.append})
+    assert response.status_code == 200
+    wait_refreshed()
+    # the refresh rendered the page, only the stale hit answered the client
+    assert renders == ['index.html']
+    assert sent == [[('Link', '</site.css>; rel=preload; as=style')]]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from ..server import SendfileWrapper, sendfile_source
+
+
+@pytest.fixture
+def wrapper(tmp_path):
+    path = tmp_path / 'file.bin'
+    path.write_bytes(bytes(1000))
+    with open(path, 'rb') as file:
+        yield SendfileWrapper(file)
+
+
+def test_whole_file(wrapper):
+    assert sendfile_source(wrapper, wrapper, 200, []) == (wrapper.file, 0, None)
+
+
+def test_range(wrapper):
+    headers = [(b'Content-Length', b'100'), (b'Content-Range', b'bytes 100-199/1000')]
+    assert sendfile_source(wrapper, iter(wrapper), 206, headers) == (wrapper.file, 100, 100)
+
+
+@pytest.mark.parametrize('code, headers', [
+    (200, []),
+    (206, []),
+    (206, [(b'Content-Range', b'bytes */1000')]),
+    (416, [(b'Content-Range', b'bytes */1000')]),
+])
+def test_body_not_the_file(wrapper, code, headers):
+    # eg. a body the compressor replaced
+    assert sendfile_source(wrapper, [b'other'], code, headers) is None
+
+
+def test_no_wrapper():
+    assert sendfile_source(None, [b'body'], 200, []) is None
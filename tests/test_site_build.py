@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from ..extensions import assets, site_build, template_analyzer
+
+
+@pytest.fixture
+def built(app, monkeypatch, tmp_path):
+    monkeypatch.setattr(site_build, 'path', str(tmp_path))
+    monkeypatch.setattr(site_build, 'serve', True)
+    site_build.build(app, jobs=1)
+    return site_build
+
+
+def test_built_page_keeps_cache_control(built, client):
+    response = client.get('/http_statuses/404.html')
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'no-store'
+
+
+def test_assets_change_stales_built_page(app, built, monkeypatch):
+    # as if the page linked a stylesheet with asset_url
+    name = 'http_statuses/404.html'
+    analyse = template_analyzer.analyse
+    info = analyse(name)
+    linking = info._replace(context_names=info.context_names | {'asset_url'})
+    monkeypatch.setattr(template_analyzer, 'analyse', lambda template: linking if template == name else analyse(template))
+
+    assert built.build(app, jobs=1)[0] == [name]
+    with app.test_request_context('/'):
+        assert built.get(name) is not None
+        monkeypatch.setattr(assets, 'version', 'rebuilt')
+        assert built.get(name) is None
+    assert built.build(app, jobs=1)[0] == [name]
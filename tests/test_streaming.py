@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+import pytest
+
+from flask import render_template, render_template_string, stream_template, stream_template_string
+from htmlmin.main import minify
+
+from ..template_minify import minify_chunks
+from .test_template_minify import RAW_TEXT
+
+
+# A page with scripts and styles whose content comes partly from the context
+PAGE = '''<!DOCTYPE html>
+<html>
+  <head>
+    <meta charset="utf-8">  <!-- head -->
+    <title>  Catalogue  {{ rows }}  </title>
+    <style> body { margin : 0 }  </style>
+    <script>var rows = {{ rows }};  if (a<b){x="abc";}
+    // done
+    y()</script>
+  </head>
+  <body>
+  {% for i in range(rows) %}
+    <p  class="row">  item {{ i }}  <!-- row --> </p>
+    <script>  var s{{ i }} = "  {{ i }}  ";  </script>
+  {% endfor %}
+  <pre>  a
+    b </pre>
+  </body>
+</html>'''
+
+
+@pytest.mark.parametrize('html', RAW_TEXT)
+def test_chunks_match_htmlmin(html):
+    chunks = [html[i:i + 3] for i in range(0, len(html), 3)]
+    assert ''.join(minify_chunks(chunks, buffer_size=4)) == minify(html, remove_comments=True)
+
+
+def test_chunks_match_htmlmin_at_any_cut(app):
+    with app.test_request_context('/'):
+        page = render_template_string(PAGE, rows=50)
+    expected = minify(page, remove_comments=True)
+
+    generator = random.Random(0)
+    for _ in range(50):
+        cuts = sorted(generator.sample(range(1, len(page)), generator.randint(1, 60)))
+        chunks = [page[i:j] for i, j in zip([0] + cuts, cuts + [len(page)])]
+        buffer_size = generator.choice([1, 10, 100, 1000])
+        assert ''.join(minify_chunks(chunks, buffer_size=buffer_size)) == expected
+
+
+@pytest.mark.parametrize('buffer_size', [1, 64, 8192])
+def test_streamed_page_matches_buffered(app, buffer_size):
+    # what response_minify does with the same page rendered at once
+    with app.test_request_context('/'):
+        expected = minify(render_template_string(PAGE, rows=200), remove_comments=True)
+        streamed = ''.join(minify_chunks(stream_template_string(PAGE, rows=200), buffer_size=buffer_size))
+    assert streamed == expected
+
+
+def test_streamed_template_matches_buffered(app):
+    context = {'error_code': 404, 'error_msg': 'Not Found'}
+    with app.test_request_context('/'):
+        expected = minify(render_template('index.html', **context), remove_comments=True)
+        streamed = ''.join(minify_chunks(stream_template('index.html', **context), buffer_size=16))
+    assert streamed == expected
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from jinja2 import DictLoader
+from htmlmin.main import minify
+
+from ..template_minify import HTMLMinifyState, MinifyExtension
+
+
+TEMPLATES = ['index.html', 'dynamic/index.html', 'static/index.html',
+             'http_statuses/403.html', 'http_statuses/404.html', 'http_statuses/500.html']
+
+# Templates with {{ }} attribute values or Jinja tags inside an html tag, their rendered
+# output is only known to htmlmin
+DYNAMIC_ATTRIBUTES = ('index.html', 'dynamic/index.html')
+
+SCRIPT = '<script>if (a<b){x="abc";}\n// done\ny()</script>'
+
+RAW_TEXT = [
+    SCRIPT,
+    '<div>\n  <script src="a.js"></script>\n  <script>\n  if (a > b && c<d) { s = \'  x  \' }\n  </script>\n</div>',
+    '<p> a </p>  <style> a { color : red }\n  b {} </style> <p>x</p>',
+    '<script>var s="</scr"+"ipt>"; </script> x',
+    '<script><!-- a --></script>',
+    '<pre>  a\n  b </pre> <textarea> x  </textarea>',
+    '<p  class="x"  id=\'\'>t</p>  <!-- c > d -->  <br />',
+]
+
+
+@pytest.mark.parametrize('html', RAW_TEXT)
+def test_matches_htmlmin(html):
+    assert HTMLMinifyState().feed(html) == minify(html, remove_comments=True)
+
+
+def test_script_left_alone():
+    assert HTMLMinifyState().feed(SCRIPT) == SCRIPT
+
+
+@pytest.mark.parametrize('name', TEMPLATES)
+def test_compiled_templates_match_htmlmin(app, name):
+    # own environments, the compiled templates must not reach the app's caches
+    plain = app.jinja_env.overlay(cache_size=0, bytecode_cache=None)
+    compiled = app.jinja_env.overlay(cache_size=0, bytecode_cache=None, extensions=[MinifyExtension])
+    compiled.minify_remove_comments = True
+    compiled.minify_exclude = ()
+
+    context = {'error_code': 404, 'error_msg': 'Not Found'}
+    with app.test_request_context('/'):
+        app.update_template_context(context)
+        plain_output = plain.get_template(name).render(context)
+        expected = minify(plain_output, remove_comments=True)
+        output = compiled.get_template(name).render(context)
+
+    if name in DYNAMIC_ATTRIBUTES:
+        # what is left for htmlmin is in the dynamic parts only
+        assert minify(output, remove_comments=True) == expected
+        assert len(output) < len(plain_output)
+    else:
+        assert output == expected
+
+
+def test_compiled_script_with_expressions(app):
+    source = '<p> a </p>\n<script>\n  var s = "{{ s }}";  if (a<b) { {% if s %}x(s){% endif %} }\n</script>  <p> b </p>'
+    environment = app.jinja_env.overlay(cache_size=0, bytecode_cache=None, extensions=[MinifyExtension],
+                                        loader=DictLoader({'page.html': source}))
+    environment.minify_remove_comments = True
+    environment.minify_exclude = ()
+
+    rendered = environment.from_string(source).render(s='  x  ')
+    assert environment.get_template('page.html').render(s='  x  ') == minify(rendered, remove_comments=True)
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import logging
+
+from flask_caching.backends.base import BaseCache
+from werkzeug.utils import import_string
+
+from .lru import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+LOOKUPS = 'site_cache_lookups_total'
+
+# Invalidation message dropping every L1 entry
+CLEAR = '*'
+
+
+class FileChannel(object):
+    """
+    invalidation messages between the processes of one host, appended to a
+    log file every process reads from its own offset
+    """
+
+    def __init__(self, path, max_size=1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        # messages from now on matter, forked workers read on from here too
+        try:
+            stat = os.stat(path)
+            self._inode, self._offset = stat.st_ino, stat.st_size
+        except OSError:
+            self._inode, self._offset = None, 0
+
+    def publish(self, keys):
+        line = json.dumps([os.getpid(), keys]) + '\n'
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # one O_APPEND write per message, the processes never interleave
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        if size > self.max_size:
+            # a new file, readers notice the inode change and drop their L1
+            tmp = f'{self.path}.tmp{os.getpid()}'
+            open(tmp, 'w').close()
+            os.replace(tmp, self.path)
+
+    def poll(self):
+        """
+        keys invalidated by the other processes since the last poll, None
+        when messages may have been missed
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return []
+
+        missed = False
+        if stat.st_ino != self._inode:
+            # created since, or rotated with messages this process did not read
+            missed = self._inode is not None
+            self._inode = stat.st_ino
+            self._offset = 0
+        if stat.st_size <= self._offset:
+            return None if missed else []
+
+        with open(self.path, 'rb') as file:
+            file.seek(self._offset)
+            data = file.read(stat.st_size - self._offset)
+        # a line still being written is read on the next poll
+        complete = data.rfind(b'\n') + 1
+        self._offset += complete
+        if missed:
+            return None
+
+        keys = []
+        pid = os.getpid()
+        for line in data[:complete].splitlines():
+            try:
+                sender, sent = json.loads(line)
+            except ValueError:
+                return None
+            if sender != pid:
+                keys += sent
+        return keys
+
+
+class RedisChannel(object):
+    """
+    invalidation messages numbered by a Redis counter, for an L2 shared by
+    several hosts; every message expires after `ttl` seconds
+    """
+
+    # number and store the message in one step, a reader never sees a number without it
+    PUBLISH = """
+    local n = redis.call('INCR', KEYS[1])
+    redis.call('SET', KEYS[1] .. ':' .. n, ARGV[1], 'EX', ARGV[2])
+    return n
+    """
+
+    def __init__(self, client, key='tiered-cache-invalidations', ttl=60, max_backlog=1000):
+        self.client = client
+        self.key = key
+        self.ttl = ttl
+        self.max_backlog = max_backlog
+        try:
+            self._last = int(client.get(key) or 0)
+        except Exception:
+            # Redis is down, the first poll starts over with an empty L1
+            self._last = None
+
+    def publish(self, keys):
+        self.client.eval(self.PUBLISH, 1, self.key, json.dumps([os.getpid(), keys]), self.ttl)
+
+    def poll(self):
+        current = int(self.client.get(self.key) or 0)
+        if self._last is None or current < self._last:
+            # unknown position, or the counter was reset
+            self._last = current
+            return None
+        if current == self._last:
+            return []
+
+        first, self._last = self._last + 1, current
+        if current - first >= self.max_backlog:
+            return None
+
+        keys = []
+        pid = os.getpid()
+        for message in self.client.mget([f'{self.key}:{n}' for n in range(first, current + 1)]):
+            if message is None:
+                # expired before this process read it
+                return None
+            sender, sent = json.loads(message)
+            if sender != pid:
+                keys += sent
+        return keys
+
+
+class TieredCache(BaseCache):
+    """
+    Flask-Caching backend with a small per-process LRU (L1) in front of a
+    backend shared by the workers (L2), set with CACHE_TYPE
+
+    Writes go to both tiers and tell the other processes to drop their L1
+    copy, CACHE_L1_TIMEOUT bounds how long a missed message can go unnoticed.
+    """
+
+    def __init__(self, l2, channel=None, default_timeout=300, l1_max_entries=512, l1_timeout=30,
+                 sync_interval=0.1, metrics=None):
+        super().__init__(default_timeout=default_timeout)
+        self.l2 = l2
+        self.channel = channel
+        self.l1 = LRUCache(max_entries=l1_max_entries)
+        self.l1_timeout = l1_timeout
+        self.sync_interval = sync_interval
+        self.metrics = metrics
+        self.l1_hits = 0
+        self.l1_misses = 0
+        self.l2_hits = 0
+        self.l2_misses = 0
+        self.invalidations = 0
+        self._synced = 0
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        l2_type = config.get('CACHE_L2_TYPE') or 'FileSystemCache'
+        if '.' not in l2_type:
+            l2_type = 'flask_caching.backends.' + l2_type
+        l2_factory = import_string(l2_type)
+        if isinstance(l2_factory, type) and issubclass(l2_factory, BaseCache):
+            l2_factory = l2_factory.factory
+        l2 = l2_factory(app, config, list(args), dict(kwargs))
+
+        if hasattr(l2, '_write_client'):
+            channel = RedisChannel(l2._write_client)
+        elif config.get('CACHE_INVALIDATION_LOG'):
+            channel = FileChannel(config['CACHE_INVALIDATION_LOG'], config.get('CACHE_INVALIDATION_LOG_SIZE'))
+        else:
+            channel = None
+
+        return cls(
+            l2,
+            channel,
+            default_timeout=kwargs.get('default_timeout', 300),
+            l1_max_entries=config.get('CACHE_L1_MAX_ENTRIES', 512),
+            l1_timeout=config.get('CACHE_L1_TIMEOUT', 30),
+            sync_interval=config.get('CACHE_L1_SYNC_INTERVAL', 0.1),
+            metrics=app.extensions.get('metrics'),
+        )
+
+    def _count(self, tier, result):
+        if self.metrics is not None:
+            self.metrics.inc(LOOKUPS, (('tier', tier), ('result', result)))
+
+    def _sync(self):
+        if self.channel is None:
+            return
+        now = time.monotonic()
+        if now - self._synced < self.sync_interval:
+            return
+        self._synced = now
+        try:
+            keys = self.channel.poll()
+        except Exception:
+            logger.exception('Cannot read cache invalidations')
+            keys = None
+        if keys is None or CLEAR in keys:
+            self.l1.clear()
+            self.invalidations += 1
+            return
+        for key in keys:
+            if self.l1.pop(key) is not None:
+                self.invalidations += 1
+
+    def _publish(self, keys):
+        if self.channel is None:
+            return
+        try:
+            self.channel.publish(keys)
+        except Exception:
+            # the others notice once their L1 entry times out
+            logger.exception('Cannot publish cache invalidations')
+
+    def _l1_set(self, key, value, timeout):
+        timeout = self._normalize_timeout(timeout)
+        ttl = self.l1_timeout if not timeout else min(timeout, self.l1_timeout)
+        self.l1.set(key, (time.monotonic() + ttl, value))
+
+    def _l1_get(self, key):
+        entry = self.l1.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            self.l1.pop(key)
+            return None
+        return value
+
+    def get(self, key):
+        self._sync()
+        value = self._l1_get(key)
+        if value is not None:
+            self.l1_hits += 1
+            self._count('l1', 'hit')
+            return value
+        self.l1_misses += 1
+        self._count('l1', 'miss')
+
+        value = self.l2.get(key)
+        if value is None:
+            self.l2_misses += 1
+            self._count('l2', 'miss')
+            return None
+        self.l2_hits += 1
+        self._count('l2', 'hit')
+        self._l1_set(key, value, self.l1_timeout)
+        return value
+
+    def get_many(self, *keys):
+        return [self.get(key) for key in keys]
+
+    def has(self, key):
+        self._sync()
+        return self._l1_get(key) is not None or self.l2.has(key)
+
+    def set(self, key, value, timeout=None):
+        stored = self.l2.set(key, value, timeout=timeout)
+        if stored:
+            self._l1_set(key, value, timeout)
+            self._publish([key])
+        return stored
+
+    def set_many(self, mapping, timeout=None):
+        stored = self.l2.set_many(mapping, timeout=timeout)
+        for key in stored:
+            self._l1_set(key, mapping[key], timeout)
+        if stored:
+            self._publish(list(stored))
+        return stored
+
+    def add(self, key, value, timeout=None):
+        added = self.l2.add(key, value, timeout=timeout)
+        if added:
+            self._l1_set(key, value, timeout)
+            self._publish([key])
+        return added
+
+    def delete(self, key):
+        self.l1.pop(key)
+        deleted = self.l2.delete(key)
+        self._publish([key])
+        return deleted
+
+    def delete_many(self, *keys):
+        for key in keys:
+            self.l1.pop(key)
+        deleted = self.l2.delete_many(*keys)
+        self._publish(list(keys))
+        return deleted
+
+    def clear(self):
+        self.l1.clear()
+        cleared = self.l2.clear()
+        self._publish([CLEAR])
+        return cleared
+
+    def inc(self, key, delta=1):
+        self.l1.pop(key)
+        value = self.l2.inc(key, delta)
+        self._publish([key])
+        return value
+
+    def dec(self, key, delta=1):
+        self.l1.pop(key)
+        value = self.l2.dec(key, delta)
+        self._publish([key])
+        return value
+
+    def stats(self):
+        l1_lookups = self.l1_hits + self.l1_misses
+        l2_lookups = self.l2_hits + self.l2_misses
+        return {
+            'l1': {
+                'entries': len(self.l1),
+                'hits': self.l1_hits,
+                'misses': self.l1_misses,
+                'hit_rate': self.l1_hits / l1_lookups if l1_lookups else 0.0,
+                'evictions': self.l1.evictions,
+            },
+            'l2': {
+                'hits': self.l2_hits,
+                'misses': self.l2_misses,
+                'hit_rate': self.l2_hits / l2_lookups if l2_lookups else 0.0,
+            },
+            'invalidations': self.invalidations,
+        }
@@ -1,10 +1,49 @@
-from gevent.pywsgi import WSGIServer
+import sys
+import argparse
+
+from gevent.pywsgi import WSGIServer, WSGIHandler
 
 from . import init_app
+from .extensions import mail_queue
+from .server import PreforkServer, SendfileHandler
 
 app = init_app()
 
 
 if __name__ == "__main__":
-    http_server = WSGIServer(("127.0.0.1", 5000), app)
-    http_server.serve_forever()
+    parser = argparse.ArgumentParser(description='Serve the site with pre-forked gevent workers.')
+    parser.add_argument('--host', default=app.config['WSGI_HOST'])
+    parser.add_argument('--port', type=int, default=app.config['WSGI_PORT'])
+    parser.add_argument('--workers', type=int, default=app.config['WSGI_WORKERS'],
+                        help='worker processes, defaults to the CPU count, 0 serves from this process')
+    parser.add_argument('--reuse-port', action='store_true', default=app.config['WSGI_REUSE_PORT'],
+                        help='one SO_REUSEPORT listener per worker instead of a shared one')
+    parser.add_argument('--no-sendfile', dest='sendfile', action='store_false', default=app.config['WSGI_SENDFILE'],
+                        help='copy files through Python instead of os.sendfile')
+    parser.add_argument('--check', action='store_true',
+                        help='exit once the application is loaded, SIGHUP runs it before reloading')
+    args = parser.parse_args()
+    if args.check:
+        sys.exit(0)
+    handler_class = SendfileHandler if args.sendfile else WSGIHandler
+
+    if args.workers == 0:
+        http_server = WSGIServer((args.host, args.port), app, handler_class=handler_class)
+        try:
+            http_server.serve_forever()
+        finally:
+            mail_queue.drain(app.config['WSGI_GRACEFUL_TIMEOUT'])
+    else:
+        PreforkServer(
+            app,
+            host=args.host,
+            port=args.port,
+            workers=args.workers,
+            reuse_port=args.reuse_port,
+            graceful_timeout=app.config['WSGI_GRACEFUL_TIMEOUT'],
+            handler_class=handler_class,
+            # what SIGHUP re-executes to load a deploy
+            command=[sys.executable, '-m', __spec__.name] + sys.argv[1:] if __spec__ else None,
+            # the contact form mails still queued in a stopping worker
+            shutdown=mail_queue.drain,
+        ).run()